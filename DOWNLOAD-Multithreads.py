@@ -1,17 +1,77 @@
 import os
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import pandas as pd
+import numpy as np
 from PIL import Image
-from io import BytesIO
-from time import sleep
-from tqdm import tqdm, trange
-from configparser import ConfigParser
+from io import BytesIO, StringIO
+from datetime import datetime
+from time import monotonic, time
+from tqdm import tqdm
+from config_utils import load_config_cached, path_exists_cached, clear_path_cache, _atomic_write_text # 带缓存的配置文件读取和路径检查，原子写入
 import logging
+import logging.handlers # QueueHandler/QueueListener：日志格式化后的写入放到后台线程
+import queue
 import traceback
 import concurrent.futures # 导入多线程模块
+import multiprocessing # 编码进程池使用 spawn 方式启动子进程
 import threading # 用于 tqdm 的锁
 import json # 导入 json 模块，用于解析API错误响应
+import random # 用于重试等待时间的随机抖动
+import csv # 用于直接读写成功/失败日志
+import hashlib # 用于生成 API Key 摘要（会话 Token 缓存）
+from collections import deque # 已预取 PanoIDs 的待处理批次队列
+from urllib.parse import urlencode # 用于预先编码瓦片 URL 的查询参数
+from functools import lru_cache
 import sys # 导入 sys 模块，用于配置基本日志器的输出流
+try:
+    from multiprocessing import shared_memory # 编码进程池使用共享内存传递拼接结果 (Python 3.8+)
+except ImportError:
+    shared_memory = None
+
+# 可选依赖：libjpeg-turbo (PyTurboJPEG)，用于加速瓦片的 JPEG 解码和全景图的 JPEG 编码。
+# 未安装 turbojpeg 包或找不到 libjpeg-turbo 动态库时回退到 PIL。
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB, TJSAMP_420
+    _tj = TurboJPEG()
+except Exception:
+    _tj = None
+
+# 可选依赖：orjson，用于更快地解析 API 返回的 JSON；未安装时使用标准库 json
+try:
+    import orjson
+    def loads_json(content):
+        """解析 API 响应体 (bytes)，解析失败抛出 json.JSONDecodeError (orjson.JSONDecodeError 是其子类)"""
+        return orjson.loads(content)
+except ImportError:
+    def loads_json(content):
+        """解析 API 响应体 (bytes)，解析失败抛出 json.JSONDecodeError"""
+        return json.loads(content.decode('utf-8', errors='replace'))
+
+# 可选依赖：httpx + h2 (pip install "httpx[http2]")，用于通过 HTTP/2 在少量连接上多路复用全部瓦片请求；
+# 未安装时使用 requests (HTTP/1.1 keep-alive 连接池)
+try:
+    import httpx
+    import h2 # noqa: F401 (httpx 的 HTTP/2 支持依赖 h2)
+except ImportError:
+    httpx = None
+
+# 两种 HTTP 客户端的网络异常统一按以下分组捕获（超时需要先于连接错误判断）
+# httpx 的协议错误 (如 HTTP/2 连接收到 GOAWAY、流被重置) 和代理错误不属于 NetworkError，
+# 但与 requests 的 ConnectionError (含 ProxyError) 一样是可重试的连接问题
+HTTP_TIMEOUT_ERRORS = (requests.exceptions.Timeout,) + ((httpx.TimeoutException,) if httpx else ())
+HTTP_CONNECTION_ERRORS = (requests.exceptions.ConnectionError,) + ((httpx.NetworkError, httpx.ProtocolError, httpx.ProxyError) if httpx else ())
+HTTP_REQUEST_ERRORS = (requests.exceptions.RequestException,) + ((httpx.HTTPError, httpx.InvalidURL) if httpx else ())
+
+# 可选依赖：pyarrow，用于多线程解析点位 CSV，并以 Arrow 字符串存储 ID 列；未安装时使用 pandas 默认的 C 解析器
+try:
+    import pyarrow
+    import pyarrow.csv
+    CSV_ENGINE = 'pyarrow'
+except ImportError:
+    pyarrow = None
+    CSV_ENGINE = 'c'
 
 # --- 错误类型常量 ---
 # 定义各种可能的错误类型，用于更细致地记录失败原因
@@ -30,8 +90,10 @@ ERROR_TYPE_API_RATE_LIMIT = "API_RATE_LIMIT" # 429 速率限制 (需要指数退
 ERROR_TYPE_API_SERVER_ERROR = "API_SERVER_ERROR" # 5xx 服务器端错误
 ERROR_TYPE_PANOID_JSON_PARSE_ERROR = "PANOID_JSON_PARSE_ERROR" # PanoId响应JSON解析失败
 ERROR_TYPE_UNCLASSIFIED_HTTP_STATUS = "UNCLASSIFIED_HTTP_STATUS" # 遇到未知HTTP状态码
-ERROR_TYPE_UNCLASSIFIED_REQUEST_ERROR = "UNCLASSIFIED_REQUEST_ERROR" # 其他requests.exceptions.RequestException
+ERROR_TYPE_UNCLASSIFIED_REQUEST_ERROR = "UNCLASSIFIED_REQUEST_ERROR" # 其他请求异常 (requests.exceptions.RequestException / httpx.HTTPError)
 ERROR_TYPE_GENERAL_EXCEPTION = "GENERAL_EXCEPTION" # 捕获到的不符合上述分类的通用异常
+# 仅在点位内部使用：同一点位的其他瓦片出现致命错误后被取消的瓦片。点位会以那个致命错误记为失败，此类型不会写入失败日志。
+ERROR_TYPE_TILE_CANCELLED = "TILE_CANCELLED"
 
 # 聚合的永久性错误类型集合，用于控制跳过逻辑。
 # 根据你的要求，只有 NO_PANOID_FOUND 会被永久跳过。
@@ -39,11 +101,159 @@ PERMANENT_SKIP_ERROR_TYPES = {
     ERROR_TYPE_NO_PANOID_FOUND
 }
 
+# HTTP 状态码 -> (错误类型, 是否值得重试)。表中没有的状态码由 classify_http_status 按区间归类。
+HTTP_STATUS_MAP = {
+    400: (ERROR_TYPE_API_BAD_REQUEST, False), # 请求参数错误
+    401: (ERROR_TYPE_API_AUTH_FORBIDDEN, False), # 认证失败
+    403: (ERROR_TYPE_API_AUTH_FORBIDDEN, False), # 权限不足或配额问题
+    429: (ERROR_TYPE_API_RATE_LIMIT, True), # 速率限制
+}
+# 瓦片请求在通用表的基础上把 404 视为瓦片不存在（不值得重试，缺失的瓦片在拼接时留黑）
+TILE_STATUS_MAP = dict(HTTP_STATUS_MAP)
+TILE_STATUS_MAP[404] = (ERROR_TYPE_ALL_TILES_MISSING, False)
+
+# 瓦片出现这些错误类型时，整个点位立即判为失败，不再拼接其他瓦片
+FATAL_TILE_ERROR_TYPES = frozenset({
+    ERROR_TYPE_API_AUTH_FORBIDDEN, # 权限/认证问题
+    ERROR_TYPE_API_BAD_REQUEST, # 请求参数错误
+    ERROR_TYPE_INTERNAL_PROCESSING_ERROR, # 内部处理错误
+    ERROR_TYPE_UNCLASSIFIED_HTTP_STATUS, # 未知 HTTP 状态码
+    ERROR_TYPE_UNCLASSIFIED_REQUEST_ERROR # 未知请求异常
+})
+
+def classify_http_status(status_code, status_map=HTTP_STATUS_MAP):
+    """
+    将非 200 的 HTTP 状态码归类。
+
+    Args:
+        status_code (int): HTTP 状态码。
+        status_map (dict): 精确匹配的状态码表，默认使用通用表 HTTP_STATUS_MAP。
+    Returns:
+        tuple: (错误类型, 是否值得重试)。
+    """
+    classified = status_map.get(status_code)
+    if classified is not None:
+        return classified
+    if 500 <= status_code < 600: # 服务器错误，值得重试
+        return ERROR_TYPE_API_SERVER_ERROR, True
+    if 400 <= status_code < 500: # 其他客户端错误
+        return ERROR_TYPE_API_BAD_REQUEST, False
+    return ERROR_TYPE_UNCLASSIFIED_HTTP_STATUS, True # 未知 HTTP 状态码
+
+# 每个点位线程对应的瓦片下载线程数；全局瓦片下载线程池大小为 MAX_POINT_WORKERS * TILE_FETCH_WORKERS
+TILE_FETCH_WORKERS = 8
+
+# max_point_workers 配置为 0 时自动选择的点位线程数：下载以等待网络为主，线程数可远多于 CPU 核心数
+def default_point_workers():
+    """返回自动选择的点位处理线程数：CPU 核心数的 8 倍，最多 32"""
+    return min(32, (os.cpu_count() or 4) * 8)
+
+# 连续这么多个点位（中间没有成功的点位）因 401/403 失败时，认为 API Key 或会话已失效：取消本批次剩余点位并停止运行
+AUTH_FAILURE_ABORT_THRESHOLD = 20
+
+# JPEG 编码参数（turbojpeg 和 PIL 两条路径保持一致）：质量 85、4:2:0 色度抽样、不做哈夫曼表优化、非渐进式，
+# 走 libjpeg-turbo 的快速编码路径
+JPEG_QUALITY = 85
+
+def save_panorama_jpeg(panorama, filepath):
+    """
+    将拼接好的 RGB 像素缓冲区编码为 JPEG 并写入文件。
+    优先使用 libjpeg-turbo (turbojpeg) 编码，不可用时回退到 PIL。
+    两种方式都先在内存中完成编码，再用一次 write 写入文件，不让编码器边编码边分块写盘。
+
+    Args:
+        panorama (numpy.ndarray): 形状为 (高, 宽, 3) 的 uint8 RGB 数组。
+        filepath (str): 输出文件路径。
+    """
+    if _tj is not None:
+        jpeg_bytes = _tj.encode(panorama, quality=JPEG_QUALITY, pixel_format=TJPF_RGB, jpeg_subsample=TJSAMP_420)
+    else:
+        jpeg_buffer = BytesIO()
+        Image.fromarray(panorama).save(jpeg_buffer, format='JPEG', quality=JPEG_QUALITY, subsampling=2, optimize=False, progressive=False)
+        jpeg_bytes = jpeg_buffer.getbuffer()
+    with open(filepath, 'wb') as f:
+        f.write(jpeg_bytes)
+
+def decode_tile(tile_content, tile_size):
+    """
+    将瓦片 JPEG 字节解码为 (高, 宽, 3) 的 uint8 RGB 数组。
+    优先用 turbojpeg 一次性解码为数组；回退到 PIL 时先用 draft() 按瓦片尺寸配置解码器并立即 load()，
+    避免惰性解码和多余的中间图像。
+
+    Args:
+        tile_content (bytes): 瓦片的 JPEG 原始字节。
+        tile_size (int): 瓦片的预期边长（像素）。
+    Returns:
+        numpy.ndarray: 解码后的 RGB 像素数组。
+    """
+    if _tj is not None:
+        return _tj.decode(tile_content, pixel_format=TJPF_RGB)
+    tile_img = Image.open(BytesIO(tile_content))
+    tile_img.draft('RGB', (tile_size, tile_size))
+    tile_img.load()
+    if tile_img.mode != 'RGB':
+        tile_img = tile_img.convert('RGB')
+    return np.asarray(tile_img)
+
+def encode_panorama_from_shm(shm_name, shape, filepath):
+    """
+    在编码进程中运行：挂载点位线程放在共享内存中的拼接结果，编码为 JPEG 并写入文件。
+    像素数据不经过序列化，也不发生复制。
+
+    Args:
+        shm_name (str): 共享内存块名称。
+        shape (tuple): 全景图数组形状 (高, 宽, 3)。
+        filepath (str): 输出文件路径。
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    panorama = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+    try:
+        save_panorama_jpeg(panorama, filepath)
+    finally:
+        del panorama
+        try:
+            shm.close()
+        except BufferError:
+            pass # 异常回溯仍持有缓冲区引用时无法立即关闭，进程内存映射会在回收时释放
+
+def allocate_panorama_buffer(shape, use_shared_memory):
+    """
+    分配全景图拼接缓冲区。缓冲区不做清零，内容未初始化：
+    每个瓦片位置都会被瓦片像素覆盖，或在瓦片缺失时由调用方单独清零为黑色。
+
+    Args:
+        shape (tuple): 数组形状 (高, 宽, 3)。
+        use_shared_memory (bool): 是否放在共享内存中（供编码进程直接读取）。
+    Returns:
+        tuple: (numpy.ndarray 缓冲区, SharedMemory 对象或 None)。使用共享内存时，调用方负责 close() 和 unlink()。
+    """
+    if not use_shared_memory:
+        return np.empty(shape, dtype=np.uint8), None
+    shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)))
+    return np.ndarray(shape, dtype=np.uint8, buffer=shm.buf), shm
+
+def is_complete_jpeg(filepath, min_size=1024):
+    """
+    判断文件是否为已完整写入的 JPEG：存在、大小超过 min_size 字节，且以 JPEG 结束标记 (FF D9) 结尾。
+    写入中途被中断的文件缺少结束标记，会被判定为不完整。
+    """
+    try:
+        if os.path.getsize(filepath) <= min_size:
+            return False
+        with open(filepath, 'rb') as f:
+            f.seek(-2, os.SEEK_END)
+            return f.read(2) == b'\xff\xd9'
+    except OSError:
+        return False
+
 # ===== 设置详细日志记录函数 =====
 def setup_logger(log_file_path, console_output_level=logging.WARNING, file_output_level=logging.DEBUG):
     """
     配置并返回一个日志记录器。
     该日志器会将所有指定级别的日志写入文件，并将指定级别及以上的日志输出到控制台。
+    日志器本身只挂一个 QueueHandler，下载线程记录日志时只需放入队列；
+    文件和控制台的写入由后台 QueueListener 线程完成，不再在下载线程中争用处理器的锁。
+    监听器保存在日志器的 queue_listener 属性上，程序结束时调用 stop_logger() 停止并写出剩余日志。
 
     Args:
         log_file_path (str): 日志文件保存的完整路径。
@@ -57,6 +267,7 @@ def setup_logger(log_file_path, console_output_level=logging.WARNING, file_outpu
 
     # 清除现有处理器，防止重复添加（如果函数被多次调用）
     # 迭代一个列表的副本，以便在迭代时修改原始列表
+    stop_logger(logger_obj)
     for handler in logger_obj.handlers[:]:
         logger_obj.removeHandler(handler)
 
@@ -66,26 +277,287 @@ def setup_logger(log_file_path, console_output_level=logging.WARNING, file_outpu
     # 定义文件日志的格式
     formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(name)s - %(filename)s:%(lineno)d - %(message)s')
     file_handler.setFormatter(formatter)
-    logger_obj.addHandler(file_handler) # 将文件处理器添加到日志器
 
     # 2. 配置控制台处理器 (StreamHandler)
     console_handler = logging.StreamHandler(sys.stdout) # 输出到标准输出流 (控制台)
     console_handler.setLevel(console_output_level) # 设置控制台处理器级别
     console_handler.setFormatter(formatter) # 控制台也使用相同的格式
-    logger_obj.addHandler(console_handler) # 将控制台处理器添加到日志器
+
+    # 3. 日志器只挂 QueueHandler，两个处理器由后台监听线程驱动（各自的级别仍然生效）
+    log_queue = queue.SimpleQueue()
+    logger_obj.addHandler(logging.handlers.QueueHandler(log_queue))
+    logger_obj.queue_listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    logger_obj.queue_listener.start()
 
     return logger_obj
 
+def stop_logger(logger_obj):
+    """停止日志器的后台监听线程，写出队列中剩余的日志并关闭处理器（未使用 setup_logger 配置时不做任何事）"""
+    listener = getattr(logger_obj, 'queue_listener', None)
+    if listener is None:
+        return
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
+    logger_obj.queue_listener = None
+
+# ===== 全局令牌桶限速器 =====
+class TokenBucket:
+    """
+    线程安全的令牌桶限速器，在所有瓦片下载线程间共享。
+    令牌以 rate 个/秒的速度补充，最多累积 burst 个；acquire() 在有令牌时立即返回，
+    否则只等待到下一个令牌产生为止，从而精确控制整体请求速率。
+    rate 为 None 或不大于 0 时不限速。
+    速率按 AIMD 方式自适应：收到 429 时减半（最低降到配置速率的 1/16），
+    之后每连续成功 recover_after 次恢复配置速率的 1/10，直到回到配置速率。
+    """
+    def __init__(self, rate, burst, recover_after=20):
+        self.rate = rate if rate and rate > 0 else None
+        self.max_rate = self.rate # 配置的速率上限
+        self.min_rate = self.rate / 16 if self.rate else None
+        self.recover_after = recover_after
+        self.success_streak = 0 # 上次调整速率后连续成功的请求数
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.last_refill = monotonic()
+        self.condition = threading.Condition()
+
+    def _refill(self):
+        """按当前速率补充令牌（调用方需持有锁）"""
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def acquire(self):
+        """取走一个令牌，令牌不足时阻塞等待"""
+        if self.rate is None:
+            return
+        with self.condition:
+            while True:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                # 只等待到下一个令牌产生所需的时间
+                self.condition.wait((1 - self.tokens) / self.rate)
+
+    def on_rate_limited(self):
+        """收到 429 时调用：速率减半"""
+        if self.rate is None:
+            return
+        with self.condition:
+            self._refill() # 先按旧速率结算已累积的令牌
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.success_streak = 0
+
+    def on_success(self):
+        """请求成功时调用：连续成功足够多次后逐步恢复速率"""
+        if self.rate is None or self.rate >= self.max_rate:
+            return
+        with self.condition:
+            self.success_streak += 1
+            if self.success_streak >= self.recover_after:
+                self._refill()
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+                self.success_streak = 0
+                self.condition.notify_all() # 速率提高后，等待中的线程可以更早取到令牌
+
+# ===== 创建共享的 HTTP 会话 =====
+def create_http_session(pool_connections, pool_maxsize):
+    """
+    创建一个在所有下载线程间共享的 HTTP 会话。
+    所有瓦片请求都发往同一主机 tile.googleapis.com，复用连接池中的 keep-alive 连接，
+    省去每个瓦片请求的 DNS 解析和 TCP/TLS 握手。
+    安装了 httpx 和 h2 时使用 HTTP/2 客户端：同时进行的瓦片请求在少数几个连接上多路复用，
+    最多建立 pool_connections 个连接；否则使用 requests.Session，每个并发请求占用一个连接。
+    两者的 get/post 调用方式和响应属性 (status_code/content/text/headers) 一致，线程安全。
+
+    Args:
+        pool_connections (int): 缓存的主机连接池数量（HTTP/2 时为最大连接数）。
+        pool_maxsize (int): 每个主机连接池保留的最大连接数，应不小于同时进行的瓦片请求数。
+    Returns:
+        httpx.Client 或 requests.Session: 配置好连接池的会话对象。
+    """
+    if httpx is not None:
+        # 与 requests 一样只对建立连接失败做底层重试；连接池等待不单独设超时（多路复用下等待很短）
+        transport = httpx.HTTPTransport(http2=True, retries=3,
+                                        limits=httpx.Limits(max_connections=max(1, pool_connections),
+                                                            max_keepalive_connections=max(1, pool_connections),
+                                                            keepalive_expiry=30))
+        return httpx.Client(http2=True, transport=transport, timeout=httpx.Timeout(10.0, pool=None))
+    http_session = requests.Session()
+    # 只对建立连接失败做底层重试；HTTP 状态码 (429/5xx 等) 的重试仍由 fetch_tile 的分类重试逻辑负责，
+    # 避免两层重试叠加并保证错误类型记录准确
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+                          max_retries=Retry(total=3, connect=3, read=0, status=0, backoff_factor=0.2))
+    http_session.mount("https://", adapter)
+    return http_session
+
+def parse_retry_after(value):
+    """
+    解析 Retry-After 响应头（秒数形式），返回需要等待的秒数。
+    缺失、为 HTTP 日期格式或无法解析时返回 0；结果最大不超过 60 秒。
+    """
+    try:
+        return min(max(float(value), 0.0), 60.0)
+    except (TypeError, ValueError):
+        return 0.0
+
+# ===== 单个瓦片下载函数 (在瓦片下载线程池中运行) =====
+def fetch_tile(http_session, rate_limiter, cancel_event, x, y, tile_url, tile_size_int, sleeptime_float, current_point_id_str, pano_id_str, logger_obj):
+    """
+    下载并解码单个瓦片，包含瓦片级别的重试和 HTTP 状态码分类。
+    这个函数运行在瓦片下载线程池中，下载成功后直接在本线程解码（解码期间释放 GIL，可在多个下载线程间并行），
+    不接触全景图对象。
+    每次发出请求（包括重试）前都从共享的令牌桶 rate_limiter 取一个令牌，并把成功和 429 反馈给它以调整整体速率。
+    cancel_event 被置位（同一点位的其他瓦片出现致命错误）后不再发出请求，直接以 ERROR_TYPE_TILE_CANCELLED 返回。
+    返回 (x, y, 解码后的 RGB 像素数组或 None, 失败原因, 失败类型)。
+    """
+    max_tile_retries = 3 # 每个瓦片的下载尝试次数
+    current_tile_retry = 0 # 当前瓦片的重试计数
+    tile_arr = None # 成功下载并解码的瓦片像素
+    
+    current_tile_error_reason = "" # 记录当前瓦片失败的详细原因
+    current_tile_error_type = "" # 记录当前瓦片失败的类型
+
+    # 瓦片下载的内部重试循环
+    while current_tile_retry < max_tile_retries:
+        retry_after_seconds = 0 # 服务端通过 Retry-After 要求的最短等待时间
+        if cancel_event.is_set(): # 点位已注定失败，不再消耗请求配额
+            return (x, y, None, f"瓦片 ({x},{y}) 已取消", ERROR_TYPE_TILE_CANCELLED)
+        rate_limiter.acquire() # 全局限速：等待令牌后再发出请求
+        try:
+            # 通过共享会话发送 GET 请求下载瓦片（复用 keep-alive 连接），设置超时
+            tile_resp = http_session.get(tile_url, timeout=10) 
+            if tile_resp.status_code == 200:
+                rate_limiter.on_success()
+                # 成功下载，立即解码为像素数组，点位线程只负责拼接（解码失败由下方的通用异常分支处理）
+                tile_arr = decode_tile(tile_resp.content, tile_size_int)
+                logger_obj.debug("线程 %d: ID: %s, PanoID: %s - 瓦片 (%d,%d) 下载成功。", threading.get_ident(), current_point_id_str, pano_id_str, x, y)
+                break # 成功，跳出瓦片内部重试循环
+            else:
+                # HTTP 状态码非 200，尝试解析 API 返回的 JSON 错误信息
+                error_detail = ""
+                try:
+                    error_json = loads_json(tile_resp.content)
+                    error_detail = error_json.get("error", {}).get("message", "") or error_json.get("message", "")
+                except json.JSONDecodeError:
+                    error_detail = tile_resp.text # 如果不是 JSON 响应，则使用原始文本
+
+                current_tile_error_reason = f"瓦片 ({x},{y}) HTTP {tile_resp.status_code}: {error_detail[:150]}..." # 截断消息以防过长
+                
+                # 根据 HTTP 状态码查表得到错误类型，以及是否值得瓦片内部重试
+                current_tile_error_type, retryable = classify_http_status(tile_resp.status_code, TILE_STATUS_MAP)
+                if current_tile_error_type == ERROR_TYPE_API_RATE_LIMIT:
+                    rate_limiter.on_rate_limited() # 降低全局请求速率
+                if not retryable or current_tile_retry == max_tile_retries - 1:
+                    break # 不值得重试（如 404、401/403、其他 4xx）或已达到最大重试次数，立即结束内部循环
+                retry_after_seconds = parse_retry_after(tile_resp.headers.get("Retry-After"))
+        # 捕获网络请求异常
+        except HTTP_TIMEOUT_ERRORS as req_e:
+            current_tile_error_reason = f"瓦片 ({x},{y}) 请求超时: {req_e}"
+            current_tile_error_type = ERROR_TYPE_NETWORK_TIMEOUT
+        except HTTP_CONNECTION_ERRORS as req_e:
+            current_tile_error_reason = f"瓦片 ({x},{y}) 连接错误: {req_e}"
+            current_tile_error_type = ERROR_TYPE_NETWORK_CONNECTION_ERROR
+        except HTTP_REQUEST_ERRORS as req_e: # 捕获其他请求异常
+            current_tile_error_reason = f"瓦片 ({x},{y}) 未知请求异常: {req_e}"
+            current_tile_error_type = ERROR_TYPE_UNCLASSIFIED_REQUEST_ERROR
+        except Exception as e: # 捕获其他通用异常
+            current_tile_error_reason = f"处理瓦片 ({x},{y}) 时发生内部错误: {e}"
+            current_tile_error_type = ERROR_TYPE_INTERNAL_PROCESSING_ERROR
+            tile_arr = None # 确保标记为失败
+            break # 立即退出瓦片内部重试循环，因为内部错误通常重试无用
+
+        # 如果瓦片下载未成功，且当前错误类型允许内部重试，则记录警告并进入下一次重试
+        if tile_arr is None and current_tile_retry < max_tile_retries:
+            logger_obj.warning(f"线程 {threading.get_ident()}: ID: {current_point_id_str}, PanoID: {pano_id_str} - {current_tile_error_reason}. 类型: {current_tile_error_type}. 重试 {current_tile_retry + 1}/{max_tile_retries}")
+        
+        current_tile_retry += 1
+        # 如果还未达到最大重试次数，进行等待（带随机抖动的指数退避）
+        if current_tile_retry < max_tile_retries:
+            # 对于 429 错误，等待时间会更长
+            if current_tile_error_type == ERROR_TYPE_API_RATE_LIMIT:
+                sleep_time_retry = min(sleeptime_float * (2 ** current_tile_retry) * 5 * random.uniform(0.5, 1.5), 60)
+            else:
+                sleep_time_retry = min(sleeptime_float * (2 ** current_tile_retry) * random.uniform(0.5, 1.5), 30) # 普通指数退避，最大 30 秒
+            # 抖动使同时遇到限流的多个线程错开重试时间；服务端给出 Retry-After 时至少等待这么久
+            # 等待期间点位被取消时立即醒来
+            cancel_event.wait(max(retry_after_seconds, sleep_time_retry))
+        else: # 达到最大重试次数，退出循环
+            break
+
+    return (x, y, tile_arr, current_tile_error_reason, current_tile_error_type)
+
+# ===== 并发下载一个全景图的全部瓦片 =====
+def fetch_all_tiles(http_session, rate_limiter, tile_executor, tile_progress, tile_jobs, tile_size_int, sleeptime_float, current_point_id_str, pano_id_str, logger_obj):
+    """
+    并发下载一个全景图的全部瓦片。
+    tile_jobs 为 (x, y, tile_url) 列表，所有瓦片请求同时提交到全局共享的瓦片下载线程池 tile_executor，
+    把 tile_cols*tile_rows 次串行网络往返压缩为约 tile_cols*tile_rows/TILE_FETCH_WORKERS 次。
+    线程池在整个运行期间复用，不再为每个点位创建和销毁线程。
+    任一瓦片出现致命错误（FATAL_TILE_ERROR_TYPES）时，取消尚未开始的瓦片任务，并通知正在重试的瓦片停止，
+    避免为注定失败的点位继续消耗请求配额。
+    每完成（或取消）一个瓦片，在整批共享的瓦片进度条 tile_progress 上计数一次。
+    返回与 tile_jobs 顺序一致的 fetch_tile 结果列表。
+    """
+    cancel_event = threading.Event()
+    tile_results = [None] * len(tile_jobs)
+    future_to_index = {
+        tile_executor.submit(fetch_tile, http_session, rate_limiter, cancel_event, x, y, tile_url, tile_size_int, sleeptime_float, current_point_id_str, pano_id_str, logger_obj): i
+        for i, (x, y, tile_url) in enumerate(tile_jobs)
+    }
+    for future in concurrent.futures.as_completed(future_to_index):
+        index = future_to_index[future]
+        if future.cancelled():
+            x, y, _ = tile_jobs[index]
+            tile_results[index] = (x, y, None, f"瓦片 ({x},{y}) 已取消", ERROR_TYPE_TILE_CANCELLED)
+        else:
+            tile_results[index] = future.result()
+            if tile_results[index][4] in FATAL_TILE_ERROR_TYPES and not cancel_event.is_set():
+                cancel_event.set()
+                for pending_future in future_to_index:
+                    pending_future.cancel() # 已在运行的任务不受影响，会在下一次重试前检查 cancel_event
+        with tqdm.get_lock(): # 多个点位线程同时计数，使用 tqdm 自带的全局锁避免计数丢失
+            tile_progress.update(1)
+    return tile_results
+
+@lru_cache(maxsize=8)
+def tile_url_prefix(zoom_int, session_token_str, api_key_str):
+    """
+    生成瓦片 URL 中与点位无关的部分（路径前缀、%d 坐标占位符、已编码的 session 和 key 参数）。
+    一次运行中只随 Token 更换而变化，结果缓存，各点位直接复用。
+    """
+    query = urlencode({'session': session_token_str, 'key': api_key_str})
+    return f"https://tile.googleapis.com/v1/streetview/tiles/{zoom_int}/%d/%d?" + query.replace('%', '%%')
+
+def build_tile_url_template(zoom_int, session_token_str, api_key_str, pano_id_str):
+    """
+    生成单个点位的瓦片 URL 模板，瓦片坐标以 %d 占位，逐瓦片使用 url_tmpl % (x, y) 得到完整 URL。
+    查询参数预先做百分号编码（session 和 key 部分整个运行期间只编码一次），生成的 URL 已是合法的 ASCII 字符串，
+    requests 发送前的重新编码检查不会再改动它。
+
+    Args:
+        zoom_int (int): 缩放级别。
+        session_token_str (str): 会话 Token。
+        api_key_str (str): API Key。
+        pano_id_str (str): 全景图 ID。
+    Returns:
+        str: 含两个 %d 占位符的 URL 模板。
+    """
+    return tile_url_prefix(zoom_int, session_token_str, api_key_str) + '&' + urlencode({'panoId': pano_id_str}).replace('%', '%%')
+
 # ===== 单个点位处理函数 (用于多线程) =====
-def process_single_point(point_data_tuple, pano_id_str, api_key_str, session_token_str, zoom_int, tile_cols_int, tile_rows_int, tile_size_int, sleeptime_float, save_dir_str, logger_obj, thread_local_storage):
+def process_single_point(http_session, rate_limiter, tile_executor, encode_executor, tile_progress, point_id, pano_id_str, api_key_str, session_token_str, zoom_int, tile_cols_int, tile_rows_int, tile_size_int, sleeptime_float, save_dir_str, logger_obj):
     """
     处理单个点位的图像下载和拼接。
-    这个函数会在一个独立的线程中运行，负责获取瓦片并将其拼接到全景图中。
+    这个函数会在一个独立的线程中运行，先通过共享的瓦片下载线程池 tile_executor 并发获取全部瓦片，再将其拼接到全景图中。
+    encode_executor 不为 None 时，拼接缓冲区放在共享内存中，JPEG 编码交给该进程池完成。
     返回一个包含处理结果的字典，包含更详细的错误类型。
     """
-    current_point_id_str = str(point_data_tuple.ID) # 从 namedtuple 获取点位 ID
+    current_point_id_str = point_id # 点位 ID（ID 列读取时已是字符串类型，无需转换）
 
-    logger_obj.info(f"线程 {threading.get_ident()}: 开始处理点位 ID: {current_point_id_str}, PanoID: {pano_id_str}")
+    logger_obj.info("线程 %d: 开始处理点位 ID: %s, PanoID: %s", threading.get_ident(), current_point_id_str, pano_id_str)
 
     # 如果 pano_id_str 为空或 None，直接返回“未找到 PanoID”的失败状态
     # 这通常发生在 PanoIds API 返回空字符串时，表示该坐标没有街景
@@ -93,144 +565,655 @@ def process_single_point(point_data_tuple, pano_id_str, api_key_str, session_tok
         logger_obj.warning(f"线程 {threading.get_ident()}: 点位 ID: {current_point_id_str} 未找到 PanoID。")
         return {"status": "failure", "id": current_point_id_str, "reason": "No panoId found for this location", "error_type": ERROR_TYPE_NO_PANOID_FOUND}
 
-    # 创建一个空白图像，用于后续拼接瓦片
-    panorama = Image.new('RGB', (tile_size_int * tile_cols_int, tile_size_int * tile_rows_int))
+    filename = f"{current_point_id_str}_{pano_id_str}.jpg"
+    filepath = os.path.join(save_dir_str, filename)
+
+    # 输出文件已存在且完整（例如上次运行在写入成功日志前中断），直接视为成功，不再重新下载瓦片
+    if is_complete_jpeg(filepath):
+        logger_obj.info("线程 %d: 点位 ID: %s, PanoID: %s - 图像已存在，跳过下载: %s", threading.get_ident(), current_point_id_str, pano_id_str, filepath)
+        return {"status": "success", "id": current_point_id_str, "panoId": pano_id_str, "file": filename}
+
+    canvas_height = tile_size_int * tile_rows_int
+    canvas_width = tile_size_int * tile_cols_int
     missing_tiles_count = 0 # 记录缺失瓦片的数量
     total_tiles = tile_cols_int * tile_rows_int # 总瓦片数
-    logger_obj.debug(f"线程 {threading.get_ident()}: ID: {current_point_id_str}, PanoID: {pano_id_str} - 创建空白图像，预期总瓦片数: {total_tiles}")
-
-    # 遍历所有瓦片坐标 (x, y)
-    # trange 提供进度条，position 用于在多线程环境下分散进度条，避免交错
-    for x in trange(tile_cols_int, desc=f"拼接 {current_point_id_str} (线程 {threading.get_ident()})", leave=False, position=threading.get_ident() % 10):
-        for y in range(tile_rows_int):
-            # 构建瓦片下载的 URL
-            tile_url = (
-                f"https://tile.googleapis.com/v1/streetview/tiles/{zoom_int}/{x}/{y}"
-                f"?session={session_token_str}&key={api_key_str}&panoId={pano_id_str}"
-            )
-            logger_obj.debug(f"线程 {threading.get_ident()}: ID: {current_point_id_str}, PanoID: {pano_id_str} - 请求瓦片 URL: {tile_url}")
-
-            max_tile_retries = 3 # 每个瓦片的下载尝试次数
-            current_tile_retry = 0 # 当前瓦片的重试计数
-            tile_download_successful = False # 标记瓦片是否成功下载
-            
-            current_tile_error_reason = "" # 记录当前瓦片失败的详细原因
-            current_tile_error_type = "" # 记录当前瓦片失败的类型
-
-            # 瓦片下载的内部重试循环
-            while current_tile_retry < max_tile_retries:
-                try:
-                    # 发送 GET 请求下载瓦片，设置超时
-                    tile_resp = requests.get(tile_url, timeout=10) 
-                    if tile_resp.status_code == 200:
-                        # 成功下载，打开图像并粘贴到全景图中
-                        tile_img = Image.open(BytesIO(tile_resp.content))
-                        panorama.paste(tile_img, (x * tile_size_int, y * tile_size_int))
-                        tile_download_successful = True
-                        logger_obj.debug(f"线程 {threading.get_ident()}: ID: {current_point_id_str}, PanoID: {pano_id_str} - 瓦片 ({x},{y}) 下载成功。")
-                        break # 成功，跳出瓦片内部重试循环
-                    else:
-                        # HTTP 状态码非 200，尝试解析 API 返回的 JSON 错误信息
-                        error_detail = ""
-                        try:
-                            error_json = tile_resp.json()
-                            error_detail = error_json.get("error", {}).get("message", "") or error_json.get("message", "")
-                        except json.JSONDecodeError:
-                            error_detail = tile_resp.text # 如果不是 JSON 响应，则使用原始文本
-
-                        current_tile_error_reason = f"瓦片 ({x},{y}) HTTP {tile_resp.status_code}: {error_detail[:150]}..." # 截断消息以防过长
-                        
-                        # 根据 HTTP 状态码精细判断错误类型
-                        if tile_resp.status_code == 404: # 瓦片不存在
-                            current_tile_error_type = ERROR_TYPE_ALL_TILES_MISSING # 标记为瓦片缺失类型
-                            break # 对于 404，通常不值得瓦片内部重试，立即结束内部循环
-                        elif tile_resp.status_code == 401 or tile_resp.status_code == 403: # 认证失败或权限问题
-                            current_tile_error_type = ERROR_TYPE_API_AUTH_FORBIDDEN # 标记为致命错误
-                            break # 致命错误不值得瓦片内部重试，立即结束内部循环
-                        elif tile_resp.status_code == 429: # 速率限制
-                            current_tile_error_type = ERROR_TYPE_API_RATE_LIMIT
-                            if current_tile_retry == max_tile_retries - 1: # 如果达到最大重试次数
-                                break # 退出瓦片内部重试
-                        elif 400 <= tile_resp.status_code < 500: # 其他客户端错误 (如400 Bad Request)
-                            current_tile_error_type = ERROR_TYPE_API_BAD_REQUEST # 通常不值得瓦片内部重试
-                            break
-                        elif 500 <= tile_resp.status_code < 600: # 服务器错误
-                            current_tile_error_type = ERROR_TYPE_API_SERVER_ERROR # 值得重试
-                            if current_tile_retry == max_tile_retries - 1: # 达到最大重试
-                                break
-                        else: # 未知 HTTP 状态码
-                            current_tile_error_type = ERROR_TYPE_UNCLASSIFIED_HTTP_STATUS
-                            if current_tile_retry == max_tile_retries - 1:
-                                break
-                # 捕获网络请求异常
-                except requests.exceptions.Timeout as req_e:
-                    current_tile_error_reason = f"瓦片 ({x},{y}) 请求超时: {req_e}"
-                    current_tile_error_type = ERROR_TYPE_NETWORK_TIMEOUT
-                except requests.exceptions.ConnectionError as req_e:
-                    current_tile_error_reason = f"瓦片 ({x},{y}) 连接错误: {req_e}"
-                    current_tile_error_type = ERROR_TYPE_NETWORK_CONNECTION_ERROR
-                except requests.exceptions.RequestException as req_e: # 捕获其他 requests 异常
-                    current_tile_error_reason = f"瓦片 ({x},{y}) 未知请求异常: {req_e}"
-                    current_tile_error_type = ERROR_TYPE_UNCLASSIFIED_REQUEST_ERROR
-                except Exception as e: # 捕获其他通用异常，如 PIL 图像处理错误
-                    current_tile_error_reason = f"处理瓦片 ({x},{y}) 时发生内部错误: {e}"
-                    current_tile_error_type = ERROR_TYPE_INTERNAL_PROCESSING_ERROR
-                    tile_download_successful = False # 确保标记为失败
-                    break # 立即退出瓦片内部重试循环，因为内部错误通常重试无用
-
-                # 如果瓦片下载未成功，且当前错误类型允许内部重试，则记录警告并进入下一次重试
-                if not tile_download_successful and current_tile_retry < max_tile_retries:
-                    logger_obj.warning(f"线程 {threading.get_ident()}: ID: {current_point_id_str}, PanoID: {pano_id_str} - {current_tile_error_reason}. 类型: {current_tile_error_type}. 重试 {current_tile_retry + 1}/{max_tile_retries}")
-                
-                current_tile_retry += 1
-                # 如果还未达到最大重试次数，进行等待（指数退避）
-                if current_tile_retry < max_tile_retries:
-                    # 对于 429 错误，等待时间会更长
-                    if current_tile_error_type == ERROR_TYPE_API_RATE_LIMIT:
-                        sleep_time_retry = min(sleeptime_float * (2 ** current_tile_retry) * 5, 60) 
-                    else:
-                        sleep_time_retry = min(sleeptime_float * (2 ** current_tile_retry), 30) # 普通指数退避，最大 30 秒
-                    sleep(sleep_time_retry)
-                else: # 达到最大重试次数，退出循环
-                    break
-            
+    logger_obj.debug("线程 %d: ID: %s, PanoID: %s - 预期总瓦片数: %d", threading.get_ident(), current_point_id_str, pano_id_str, total_tiles)
+
+    # 先构建所有瓦片坐标 (x, y) 及其下载 URL；URL 模板每个点位只生成一次，逐瓦片只做一次 % 格式化
+    url_tmpl = build_tile_url_template(zoom_int, session_token_str, api_key_str, pano_id_str)
+    tile_jobs = [
+        (x, y, url_tmpl % (x, y))
+        for x in range(tile_cols_int)
+        for y in range(tile_rows_int)
+    ]
+    logger_obj.debug("线程 %d: ID: %s, PanoID: %s - 请求瓦片 URL 模板: %s", threading.get_ident(), current_point_id_str, pano_id_str, url_tmpl)
+
+    # 并发下载并解码全部瓦片，全部返回后再在当前线程中统一拼接
+    tile_results = fetch_all_tiles(http_session, rate_limiter, tile_executor, tile_progress, tile_jobs, tile_size_int, sleeptime_float, current_point_id_str, pano_id_str, logger_obj)
+
+    # 如果有瓦片遇到被认为是致命的错误类型，直接返回点位失败，不再分配缓冲区和拼接其他瓦片
+    for x, y, tile_arr, tile_error_reason, tile_error_type in tile_results:
+        if tile_error_type in FATAL_TILE_ERROR_TYPES:
+            logger_obj.error(f"线程 {threading.get_ident()}: ID: {current_point_id_str}, PanoID: {pano_id_str} - 瓦片 ({x},{y}) 最终下载失败。原因: {tile_error_reason}, 类型: {tile_error_type}")
+            return {"status": "failure", "id": current_point_id_str, "reason": tile_error_reason, "error_type": tile_error_type}
+
+    # 创建一块连续的 RGB 像素缓冲区，用于拼接瓦片（不预先清零，缺失的瓦片位置单独填为黑色）
+    # 启用编码进程池时缓冲区放在共享内存中，编码进程可以直接读取
+    panorama, panorama_shm = allocate_panorama_buffer((canvas_height, canvas_width, 3), use_shared_memory=encode_executor is not None)
+    try:
+        for x, y, tile_arr, tile_error_reason, tile_error_type in tile_results:
+            top, left = y * tile_size_int, x * tile_size_int
             # 如果瓦片在多次内部重试后仍未成功下载
-            if not tile_download_successful:
+            if tile_arr is None:
                 missing_tiles_count += 1
-                logger_obj.error(f"线程 {threading.get_ident()}: ID: {current_point_id_str}, PanoID: {pano_id_str} - 瓦片 ({x},{y}) 最终下载失败。原因: {current_tile_error_reason}, 类型: {current_tile_error_type}")
-                
-                # 如果遇到被认为是致命的错误类型，立即返回点位失败，不再尝试其他瓦片
-                if current_tile_error_type in {
-                    ERROR_TYPE_API_AUTH_FORBIDDEN, # 权限/认证问题
-                    ERROR_TYPE_API_BAD_REQUEST, # 请求参数错误
-                    ERROR_TYPE_INTERNAL_PROCESSING_ERROR, # 内部处理错误
-                    ERROR_TYPE_UNCLASSIFIED_HTTP_STATUS, # 未知 HTTP 状态码
-                    ERROR_TYPE_UNCLASSIFIED_REQUEST_ERROR # 未知请求异常
-                }:
-                    return {"status": "failure", "id": current_point_id_str, "reason": current_tile_error_reason, "error_type": current_tile_error_type}
-
-
-            sleep(sleeptime_float) # 每次瓦片下载后的固定间隔
-
-    # 如果所有瓦片都缺失（并且在瓦片下载循环中没有提前返回致命错误）
-    if missing_tiles_count == total_tiles:
-        logger_obj.warning(f"线程 {threading.get_ident()}: 点位 ID: {current_point_id_str}, PanoID: {pano_id_str} - 所有瓦片均缺失，跳过保存。")
-        # 这通常表示 PanoId 无效（即使不是 None，瓦片本身也返回 404）或者持续的网络/API 问题
-        return {"status": "failure", "id": current_point_id_str, "reason": "All tiles missing after repeated attempts", "error_type": ERROR_TYPE_ALL_TILES_MISSING}
-
-    # 成功拼接所有瓦片，尝试保存图像
-    filename = f"{current_point_id_str}_{pano_id_str}.jpg"
-    filepath = os.path.join(save_dir_str, filename)
+                logger_obj.error(f"线程 {threading.get_ident()}: ID: {current_point_id_str}, PanoID: {pano_id_str} - 瓦片 ({x},{y}) 最终下载失败。原因: {tile_error_reason}, 类型: {tile_error_type}")
+                panorama[top:top + tile_size_int, left:left + tile_size_int] = 0 # 缺失的瓦片位置填为黑色
+                continue
+
+            try:
+                # 将已解码的瓦片像素直接写入缓冲区的对应切片（超出画布的部分会被裁掉）
+                tile_h = min(tile_arr.shape[0], canvas_height - top)
+                tile_w = min(tile_arr.shape[1], canvas_width - left)
+                if tile_h < tile_size_int or tile_w < tile_size_int:
+                    panorama[top:top + tile_size_int, left:left + tile_size_int] = 0 # 瓦片小于格子时，未覆盖的部分填为黑色
+                panorama[top:top + tile_h, left:left + tile_w] = tile_arr[:tile_h, :tile_w]
+            except Exception as e: # 捕获瓦片像素写入错误（如通道数不符）
+                tile_error_reason = f"处理瓦片 ({x},{y}) 时发生内部错误: {e}"
+                logger_obj.error(f"线程 {threading.get_ident()}: ID: {current_point_id_str}, PanoID: {pano_id_str} - {tile_error_reason}")
+                return {"status": "failure", "id": current_point_id_str, "reason": tile_error_reason, "error_type": ERROR_TYPE_INTERNAL_PROCESSING_ERROR}
+
+        # 如果所有瓦片都缺失（并且没有因致命错误提前返回）
+        if missing_tiles_count == total_tiles:
+            logger_obj.warning(f"线程 {threading.get_ident()}: 点位 ID: {current_point_id_str}, PanoID: {pano_id_str} - 所有瓦片均缺失，跳过保存。")
+            # 这通常表示 PanoId 无效（即使不是 None，瓦片本身也返回 404）或者持续的网络/API 问题
+            return {"status": "failure", "id": current_point_id_str, "reason": "All tiles missing after repeated attempts", "error_type": ERROR_TYPE_ALL_TILES_MISSING}
+
+        # 成功拼接所有瓦片，尝试保存图像
+        try:
+            if panorama_shm is not None:
+                # 编码进程直接读取共享内存中的像素，不复制也不序列化
+                encode_executor.submit(encode_panorama_from_shm, panorama_shm.name, panorama.shape, filepath).result()
+            else:
+                save_panorama_jpeg(panorama, filepath)
+            logger_obj.info("线程 %d: 点位 ID: %s, PanoID: %s - 图像成功保存至: %s", threading.get_ident(), current_point_id_str, pano_id_str, filepath)
+            return {"status": "success", "id": current_point_id_str, "panoId": pano_id_str, "file": filename}
+        except Exception as e_save: # 捕获保存图像时可能发生的异常
+            logger_obj.error(f"线程 {threading.get_ident()}: 点位 ID: {current_point_id_str}, PanoID: {pano_id_str} - 保存图像失败: {e_save}", exc_info=True)
+            return {"status": "failure", "id": current_point_id_str, "reason": f"Save image failed: {e_save}", "error_type": ERROR_TYPE_INTERNAL_PROCESSING_ERROR}
+    finally:
+        if panorama_shm is not None:
+            del panorama # 先释放对缓冲区的引用，才能关闭共享内存
+            panorama_shm.close()
+            panorama_shm.unlink()
+
+
+# ===== 街景会话 Token：创建与跨运行缓存 =====
+SESSION_TOKEN_CACHE_PATH = '.session_token.json' # 会话 Token 缓存文件（与 configuration.ini 位于同一工作目录）
+SESSION_TOKEN_TTL_SECONDS = 20 * 60 # 缓存的 Token 最多复用 20 分钟（保守取值，远小于 Token 的实际有效期）
+
+def create_session_token(http_session, api_key_str, logger_obj):
+    """
+    请求 createSession 接口创建街景会话 Token。
+
+    Args:
+        http_session (httpx.Client 或 requests.Session): 共享的 HTTP 会话，与瓦片请求复用同一连接池。
+        api_key_str (str): Google Maps API Key。
+        logger_obj (logging.Logger): 日志器对象。
+    Returns:
+        tuple: (session_token, expiry)。expiry 为接口返回的过期时间 (Unix 时间戳，秒)，缺失时为 None。
+    Raises:
+        Exception: 请求失败或响应中没有 Token 时抛出，异常信息包含失败原因。
+    """
+    session_payload = {"mapType": "streetview", "language": "en-US", "region": "US"}
     try:
-        panorama.save(filepath)
-        logger_obj.info(f"线程 {threading.get_ident()}: 点位 ID: {current_point_id_str}, PanoID: {pano_id_str} - 图像成功保存至: {filepath}")
-        return {"status": "success", "id": current_point_id_str, "panoId": pano_id_str, "file": filename}
-    except Exception as e_save: # 捕获保存图像时可能发生的异常
-        logger_obj.error(f"线程 {threading.get_ident()}: 点位 ID: {current_point_id_str}, PanoID: {pano_id_str} - 保存图像失败: {e_save}", exc_info=True)
-        return {"status": "failure", "id": current_point_id_str, "reason": f"Save image failed: {e_save}", "error_type": ERROR_TYPE_INTERNAL_PROCESSING_ERROR}
+        # 发送请求创建会话 Token
+        session_response = http_session.post(f"https://tile.googleapis.com/v1/createSession?key={api_key_str}", headers={"Content-Type": "application/json"}, json=session_payload, timeout=15)
+        
+        if session_response.status_code == 200:
+            # 成功获取 Token
+            session_data = loads_json(session_response.content)
+            session_token = session_data.get("session")
+            if not session_token:
+                error_msg = f"无法获取 session token，响应内容：{session_response.text}"
+                logger_obj.error(error_msg)
+                print(f"❌ {error_msg}") # 在控制台显示错误，因为这是一个可能导致程序无法继续的严重错误
+                raise Exception("无法获取 session token")
+            logger_obj.info(f"成功获取 Session Token: {session_token[:10]}...")
+            try:
+                session_expiry = float(session_data.get("expiry"))
+            except (TypeError, ValueError):
+                session_expiry = None # 响应中没有可用的过期时间，只按缓存有效期判断
+            return session_token, session_expiry
+        else:
+            # Session Token 请求失败（非 200 状态码）
+            error_detail = ""
+            try:
+                error_json = loads_json(session_response.content)
+                error_detail = error_json.get("error", {}).get("message", "") or error_json.get("message", "")
+            except json.JSONDecodeError:
+                error_detail = session_response.text
+
+            error_reason = f"创建 Session Token 请求失败。状态码: {session_response.status_code}, 消息: {error_detail[:200]}..."
+            logger_obj.error(error_reason) # 记录到文件和控制台 (因为是 ERROR 级别)
+            print(f"❌ {error_reason}") # 确保在控制台显示给用户
+
+            # 根据状态码判断并抛出特定异常
+            if session_response.status_code == 401 or session_response.status_code == 403:
+                raise Exception(f"创建 Session Token 失败: API Key 无效或权限不足 ({error_reason})")
+            elif session_response.status_code == 429:
+                raise Exception(f"创建 Session Token 失败: 速率限制，请稍后再试 ({error_reason})")
+            elif session_response.status_code >= 500:
+                raise Exception(f"创建 Session Token 失败: 服务器内部错误，可能暂时性 ({error_reason})")
+            elif session_response.status_code == 400:
+                raise Exception(f"创建 Session Token 失败: 请求参数错误 ({error_reason})")
+            else:
+                raise Exception(f"创建 Session Token 失败: 未知HTTP状态码 ({error_reason})")
+    except HTTP_TIMEOUT_ERRORS as req_e:
+        logger_obj.error(f"创建 Session Token 请求超时: {req_e}", exc_info=True)
+        print(f"❌ 创建 Session Token 请求超时: {req_e}")
+        raise Exception(f"创建 Session Token 请求超时: {req_e}")
+    except HTTP_CONNECTION_ERRORS as req_e:
+        logger_obj.error(f"创建 Session Token 连接错误: {req_e}", exc_info=True)
+        print(f"❌ 创建 Session Token 连接错误: {req_e}")
+        raise Exception(f"创建 Session Token 连接错误: {req_e}")
+    except HTTP_REQUEST_ERRORS as req_e:
+        logger_obj.error(f"创建 Session Token 请求发生未知异常: {req_e}", exc_info=True)
+        print(f"❌ 创建 Session Token 请求发生未知异常: {req_e}")
+        raise Exception(f"创建 Session Token 请求发生未知异常: {req_e}")
+    except Exception as e_session_general:
+        logger_obj.error(f"创建 Session Token 发生意外错误: {e_session_general}", exc_info=True)
+        print(f"❌ 创建 Session Token 发生意外错误: {e_session_general}")
+        raise Exception(f"创建 Session Token 发生意外错误: {e_session_general}")
+
+def _api_key_fingerprint(api_key_str):
+    """API Key 的摘要，用于判断缓存的 Token 是否属于当前 Key（缓存文件中不保存 Key 原文）"""
+    return hashlib.sha256(api_key_str.encode('utf-8')).hexdigest()[:16]
+
+def load_cached_session_token(cache_path, api_key_str):
+    """
+    读取上次运行缓存的会话 Token。
+    Token 属于当前 API Key、获取时间未超过 SESSION_TOKEN_TTL_SECONDS、且距接口返回的过期时间还有至少 60 秒时才返回，否则返回 None。
+    """
+    try:
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            cached = json.load(f)
+        if cached.get('key') != _api_key_fingerprint(api_key_str):
+            return None
+        now = time()
+        if now - float(cached.get('ts', 0)) >= SESSION_TOKEN_TTL_SECONDS:
+            return None
+        expiry = cached.get('expiry')
+        if expiry is not None and now >= float(expiry) - 60:
+            return None
+        return cached.get('token') or None
+    except (OSError, ValueError, TypeError, AttributeError):
+        return None # 缓存不存在或已损坏
+
+def save_session_token(cache_path, api_key_str, session_token, expiry):
+    """缓存会话 Token 及其获取时间，供之后的运行复用；写入失败不影响本次运行"""
+    try:
+        with open(cache_path, 'w', encoding='utf-8') as f:
+            json.dump({'token': session_token, 'ts': time(), 'expiry': expiry, 'key': _api_key_fingerprint(api_key_str)}, f)
+    except OSError:
+        pass
 
+def invalidate_session_token(cache_path):
+    """删除缓存的会话 Token"""
+    try:
+        os.remove(cache_path)
+    except OSError:
+        pass
+
+# ===== PanoID 请求 =====
+PANOID_CHUNK_SIZE = 100 # panoIds 接口单次请求的最大地点数，超过时拆分为多个并发请求
+
+class PanoIdRequestError(Exception):
+    """PanoIDs 请求失败，携带失败原因、错误类型和 HTTP 状态码（网络异常时为 None）"""
+    def __init__(self, reason, error_type, status_code=None):
+        super().__init__(reason)
+        self.reason = reason
+        self.error_type = error_type
+        self.status_code = status_code
+
+def request_pano_ids(http_session, session_token_str, api_key_str, locations, logger_obj):
+    """
+    请求一组地点（不超过 PANOID_CHUNK_SIZE 个）对应的 PanoID。
 
-if __name__ == "__main__":
+    Args:
+        http_session (httpx.Client 或 requests.Session): 共享的 HTTP 会话。
+        session_token_str (str): 会话 Token。
+        api_key_str (str): API Key。
+        locations (list): [{"lat": ..., "lng": ...}, ...] 地点列表。
+        logger_obj (logging.Logger): 日志器对象。
+    Returns:
+        list: 与 locations 等长的 PanoID 列表，没有街景的地点为空字符串；接口返回数量不足时用 None 补齐。
+    Raises:
+        PanoIdRequestError: 请求失败、返回非 200 状态码或响应无法解析时抛出。
+    """
+    panoid_url = f"https://tile.googleapis.com/v1/streetview/panoIds?session={session_token_str}&key={api_key_str}"
+    try:
+        response_pano_ids = http_session.post(panoid_url, json={"locations": locations, "radius": 50}, timeout=20)
+    except HTTP_TIMEOUT_ERRORS as req_e_pano: # PanoIDs 请求超时
+        raise PanoIdRequestError(f"获取 PanoIDs 请求超时: {req_e_pano}", ERROR_TYPE_NETWORK_TIMEOUT)
+    except HTTP_CONNECTION_ERRORS as req_e_pano: # PanoIDs 连接错误
+        raise PanoIdRequestError(f"获取 PanoIDs 连接错误: {req_e_pano}", ERROR_TYPE_NETWORK_CONNECTION_ERROR)
+    except HTTP_REQUEST_ERRORS as req_e_pano: # 其他请求异常
+        raise PanoIdRequestError(f"获取 PanoIDs 请求发生未知异常: {req_e_pano}", ERROR_TYPE_UNCLASSIFIED_REQUEST_ERROR)
+
+    if response_pano_ids.status_code != 200:
+        # PanoIDs 请求失败（非 200 状态码）
+        error_detail = ""
+        try:
+            error_json = loads_json(response_pano_ids.content)
+            error_detail = error_json.get("error", {}).get("message", "") or error_json.get("message", "")
+        except json.JSONDecodeError:
+            error_detail = response_pano_ids.text
+
+        # 根据状态码查表判断 PanoID 请求的错误类型
+        error_type, _ = classify_http_status(response_pano_ids.status_code)
+        raise PanoIdRequestError(f"获取 PanoIDs 请求失败。状态码: {response_pano_ids.status_code}, 消息: {error_detail[:200]}...",
+                                 error_type, response_pano_ids.status_code)
+
+    try:
+        pano_ids = loads_json(response_pano_ids.content).get("panoIds", [])
+    except json.JSONDecodeError: # JSON 解析失败
+        raise PanoIdRequestError(f"获取 PanoIDs 成功，但JSON解析失败。响应文本: {response_pano_ids.text[:200]}...",
+                                 ERROR_TYPE_PANOID_JSON_PARSE_ERROR, response_pano_ids.status_code)
+    # Google API 通常会返回与请求 locations 数量相同的 panoIds 列表（没有 panoId 的地点为空字符串），
+    # 以防万一长度不匹配，按每个分块分别用 None 补齐，保证与地点一一对应
+    # 数量一致（绝大多数情况）时直接返回接口给出的列表，不做复制
+    if len(pano_ids) != len(locations):
+        logger_obj.warning(f"PanoID数量({len(pano_ids)})与地点数({len(locations)})不匹配。将按地点数迭代，PanoID不足处会为None。")
+        pano_ids = pano_ids[:len(locations)] + [None] * (len(locations) - len(pano_ids))
+    return pano_ids
+
+def submit_pano_id_requests(panoid_executor, http_session, session_token_str, api_key_str, locations, logger_obj):
+    """
+    将地点列表按 PANOID_CHUNK_SIZE 拆分，各分块的 PanoIDs 请求并发提交到 panoid_executor。
+    返回按分块顺序排列的 Future 列表，由 collect_pano_ids 汇总结果。
+    """
+    return [
+        panoid_executor.submit(request_pano_ids, http_session, session_token_str, api_key_str, locations[start:start + PANOID_CHUNK_SIZE], logger_obj)
+        for start in range(0, len(locations), PANOID_CHUNK_SIZE)
+    ]
+
+def collect_pano_ids(panoid_futures):
+    """
+    按顺序等待各分块的 PanoIDs 请求并拼接结果。
+    任一分块失败时抛出该分块的 PanoIdRequestError，整批按同一原因记为失败。
+    """
+    pano_ids_data = []
+    for panoid_future in panoid_futures:
+        pano_ids_data.extend(panoid_future.result())
+    return pano_ids_data
+
+# ===== 批次选择 =====
+# 点位 CSV 中用到的列及其类型。安装了 pyarrow 时 ID 列使用 Arrow 字符串：字符连续存放在一块缓冲区中，
+# 不为每个 ID 分配 Python 字符串对象，跳过集合的 isin 过滤和重复 ID 检查也在 Arrow 的向量化实现中完成
+POINT_COLUMN_DTYPES = {'ID': 'string[pyarrow]' if CSV_ENGINE == 'pyarrow' else 'string', 'Lat': 'float64', 'Lng': 'float64'}
+
+def read_points_csv(csv_path):
+    """
+    读取点位 CSV，只加载用到的 ID/Lat/Lng 三列并直接指定列类型，省去其他列的内存和类型推断。
+    先读取表头确定实际存在的列（缺少 Lat/Lng 时不报错，由调用方的列检查给出提示），
+    安装了 pyarrow 时使用其多线程解析器。两种解析器都把 ID 当作文本读取（保留前导零，空 ID 为缺失值），
+    安装或卸载 pyarrow 不会改变 ID、输出文件名和日志中的记录。
+
+    Args:
+        csv_path (str): 点位 CSV 文件路径。
+    Returns:
+        pandas.DataFrame: 点位数据，只包含 CSV 中存在的 ID/Lat/Lng 列。
+    """
+    with open(csv_path, 'r', encoding='utf-8-sig', newline='') as f:
+        header = next(csv.reader(f), [])
+    usecols = [col for col in POINT_COLUMN_DTYPES if col in header]
+    if not usecols:
+        return pd.DataFrame(columns=header)
+    dtype = {col: POINT_COLUMN_DTYPES[col] for col in usecols}
+    if CSV_ENGINE == 'pyarrow':
+        # 直接调用 pyarrow.csv 并在解析时指定列类型：pandas 的 engine='pyarrow' 会先推断类型再 astype，
+        # ID 列会先被解析为整数或浮点数（'00123' 变成 '123'，含空值时变成 '1.0'）
+        arrow_types = {'ID': pyarrow.string(), 'Lat': pyarrow.float64(), 'Lng': pyarrow.float64()}
+        convert_options = pyarrow.csv.ConvertOptions(
+            column_types={col: arrow_types[col] for col in usecols},
+            include_columns=usecols,
+            strings_can_be_null=True, # 空 ID 与 C 解析器一样读为缺失值
+        )
+        table = pyarrow.csv.read_csv(csv_path, convert_options=convert_options)
+        return table.to_pandas(types_mapper={pyarrow.string(): pd.StringDtype('pyarrow')}.get)
+    return pd.read_csv(csv_path, usecols=usecols, dtype=dtype, memory_map=True)
+
+def match_legacy_ids(csv_path, point_ids, unmatched_log_ids):
+    """
+    兼容旧版本日志中的 ID。
+    旧版本用 pandas 默认类型推断读取点位 CSV 后再把 ID 列 astype(str)：纯数字 ID 会丢失前导零（'00123' -> '123'），
+    含空 ID 的列会被推断为浮点数（'123' -> '123.0'），旧的成功/失败日志中记录的是这种形式的 ID。
+    这里按旧方式重新读取一次 ID 列，逐行与当前读取的 ID 对应，找出旧形式 ID 出现在日志中的点位。
+
+    Args:
+        csv_path (str): 点位 CSV 文件路径。
+        point_ids (pandas.Series): read_points_csv 读取的 ID 列（尚未删除空 ID 的行，与文件中的数据行一一对应）。
+        unmatched_log_ids (set): 日志中有、但点位 CSV 中找不到的 ID。
+
+    Returns:
+        set: 旧形式 ID 出现在 unmatched_log_ids 中的点位的当前 ID。
+    """
+    legacy_ids = pd.read_csv(csv_path, usecols=['ID'])['ID'].astype(str)
+    if len(legacy_ids) != len(point_ids):
+        # 两次读取的行数不一致时无法逐行对应，不做兼容匹配
+        return set()
+    matched = legacy_ids.isin(unmatched_log_ids).to_numpy() & point_ids.notna().to_numpy()
+    return set(point_ids[matched])
+
+def batch_locations(batch_df):
+    """
+    将批次点位的经纬度组装为 PanoIDs 请求的地点列表。
+    整列取出为数组后再组装，避免 iterrows 为每一行构造一个 Series。
+    """
+    lat_list = batch_df['Lat'].to_numpy(dtype=float).tolist()
+    lng_list = batch_df['Lng'].to_numpy(dtype=float).tolist()
+    return [{"lat": lat, "lng": lng} for lat, lng in zip(lat_list, lng_list)]
+
+class PendingPoints:
+    """
+    按 CSV 顺序逐批取出待处理点位。
+    启动时根据跳过集合计算一次待处理掩码，并只为 CSV 中重复出现的 ID 建立行号索引；之后每取出一批只翻转这批点位
+    （连同 CSV 中重复出现的同一 ID）所在行的掩码位，并从上一批最后一行之后继续向后查找，
+    每批的开销只与批次大小有关，不再随 CSV 总行数增长。
+    """
+    def __init__(self, all_df, ids_to_skip):
+        self.all_df = all_df
+        self.mask = ~all_df['ID'].isin(ids_to_skip).to_numpy()
+        self.is_duplicate = all_df['ID'].duplicated(keep=False).to_numpy() # 该行的 ID 是否在 CSV 中出现多次
+        duplicate_rows = np.flatnonzero(self.is_duplicate)
+        duplicate_ids = all_df['ID'].iloc[duplicate_rows].reset_index(drop=True)
+        self.id_rows = { # 重复 ID -> 该 ID 所在的全部行号（ID 唯一的行无需索引）
+            point_id: duplicate_rows[positions]
+            for point_id, positions in duplicate_ids.groupby(duplicate_ids, sort=False).indices.items()
+        }
+        self.cursor = 0 # 此行之前的点位都已被取出或跳过
+
+    def take(self, batch_size):
+        """
+        取出接下来最多 batch_size 个待处理点位，并立即将其标记为已取出。
+
+        Returns:
+            pandas.DataFrame: 批次点位，没有待处理点位时为空。
+        """
+        rows = []
+        found = 0
+        window = max(batch_size, 1024)
+        start = self.cursor
+        while start < len(self.mask) and found < batch_size:
+            hits = np.flatnonzero(self.mask[start:start + window])[:batch_size - found] + start
+            rows.append(hits)
+            found += len(hits)
+            start += window
+            window *= 2 # 待处理点位稀疏时逐步扩大查找窗口
+        rows = np.concatenate(rows) if rows else np.empty(0, dtype=np.intp)
+        self.cursor = int(rows[-1]) + 1 if len(rows) else len(self.mask)
+        self.mask[rows] = False
+        batch_df = self.all_df.iloc[rows]
+        if self.is_duplicate[rows].any(): # 只需处理 ID 重复的行
+            for point_id in batch_df['ID'].to_numpy()[self.is_duplicate[rows]]:
+                self.mask[self.id_rows[point_id]] = False
+            # 同一 ID 在本批次中出现多次时只保留第一次，避免重复请求 PanoID 并同时写入同一个输出文件
+            batch_df = batch_df[~batch_df['ID'].duplicated().to_numpy()]
+        return batch_df
+
+def prefetch_batches(panoid_executor, http_session, session_token_str, api_key_str, pending_points, batch_size, max_batches, logger_obj):
+    """
+    取出接下来的一组批次，并立即为整组提交 PanoIDs 请求。
+    批次中的每个点位最终都会被记为成功或失败，因此取出后即视为已处理，
+    下一组批次在当前批次下载瓦片期间就能确定并提前发出 PanoIDs 请求。
+    batch_size 小于 PANOID_CHUNK_SIZE 时，一组包含多个批次（最多 max_batches 个），
+    它们的地点合并后按 PANOID_CHUNK_SIZE 分块请求，用更少、更满的请求代替每批次一个小请求。
+
+    Args:
+        panoid_executor (concurrent.futures.Executor): PanoIDs 请求线程池。
+        http_session (httpx.Client 或 requests.Session): 共享的 HTTP 会话。
+        session_token_str (str): 会话 Token。
+        api_key_str (str): API Key。
+        pending_points (PendingPoints): 待处理点位。
+        batch_size (int): 每批次点位数。
+        max_batches (int): 最多取出的批次数（剩余的批次数）。
+        logger_obj (logging.Logger): 日志器对象。
+    Returns:
+        list: [(批次 DataFrame, 整组共用的 PanoIDs Future 列表, 本批次在整组结果中的起始位置, 请求使用的 Session Token), ...]。
+            待处理点位取完时，最后一项为空批次。
+    """
+    group_size = max(1, min(max_batches, PANOID_CHUNK_SIZE // max(batch_size, 1)))
+    batch_dfs = []
+    for _ in range(group_size):
+        batch_df = pending_points.take(batch_size)
+        batch_dfs.append(batch_df)
+        if batch_df.empty:
+            break
+    locations = [location for batch_df in batch_dfs for location in batch_locations(batch_df)]
+    panoid_futures = submit_pano_id_requests(panoid_executor, http_session, session_token_str, api_key_str, locations, logger_obj)
+    batches = []
+    offset = 0
+    for batch_df in batch_dfs:
+        batches.append((batch_df, panoid_futures, offset, session_token_str))
+        offset += len(batch_df)
+    return batches
+
+# ===== 成功/失败日志 (CSV) 读写函数 =====
+FAIL_LOG_COLUMNS = ['ID', 'Reason', 'error_type']
+BATCH_RESULT_COLUMNS = ['ID', 'panoId', 'file'] # 每批次结果文件 results_batch_*.csv 的列
+
+def load_success_ids(log_path, logger_obj):
+    """
+    读取成功日志，返回已成功下载的 ID 集合。
+    只需要 ID 列的成员判断，直接用 csv 模块逐行读取，不构建 DataFrame。
+    成功记录在运行中直接追加到日志末尾（每行只有 ID），因此 'ID' 不是第一列时，
+    会把 'ID' 列移到第一列后整体写回（其他列原样保留，先写临时文件再替换，中途出错不会截断日志）；
+    缺少 'ID' 列的日志不会被改写，而是改名备份后新建一个只有表头的成功日志。
+    """
+    with open(log_path, 'r', newline='', encoding='utf-8-sig') as f: # Excel 另存的“CSV UTF-8”带 BOM
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+            logger_obj.warning(f"成功日志 '{log_path}' 为空。")
+            write_csv_header(log_path, ['ID'])
+            return set()
+        if 'ID' not in header:
+            id_index = None
+        else:
+            id_index = header.index('ID')
+            if id_index == 0: # 常见情况：追加的行与表头对齐，无需改写
+                return {row[0] for row in reader if row and row[0]}
+            rows = list(reader)
+    if id_index is None:
+        backup_path = f"{log_path}.{datetime.now().strftime('%Y%m%d_%H%M%S')}.bak"
+        os.replace(log_path, backup_path)
+        write_csv_header(log_path, ['ID'])
+        logger_obj.warning(f"成功日志 '{log_path}' 中缺少 'ID' 列，原文件已备份为 '{backup_path}'，并新建了空的成功日志。")
+        return set()
+
+    # 'ID' 列移到第一列，使之后追加的只有 ID 的行与表头对齐
+    column_order = [id_index] + [i for i in range(len(header)) if i != id_index]
+    def reorder(row):
+        return [row[i] if i < len(row) else '' for i in column_order]
+    buffer = StringIO()
+    writer = csv.writer(buffer, lineterminator='\n') # 文本模式写入时按平台转换换行符
+    writer.writerow(reorder(header))
+    writer.writerows(reorder(row) for row in rows)
+    _atomic_write_text(log_path, buffer.getvalue())
+    logger_obj.info(f"成功日志 '{log_path}' 的 'ID' 列已移到第一列。")
+    return {row[id_index] for row in rows if len(row) > id_index and row[id_index]}
+
+def load_fail_log(fail_log_path, logger_obj):
+    """
+    读取失败日志，返回 (全部失败 ID 集合, 永久失败 ID 集合, 已记录的 (ID, Reason, error_type) 集合)。
+    旧格式日志（缺少 'error_type' 列）会被一次性迁移为新格式：根据 Reason 推断出的
+    NO_PANOID_FOUND 记录保留该类型，其余记录填充 GENERAL_EXCEPTION，之后即可直接追加新记录。
+    按列下标逐行读取，只取 ID/Reason/error_type 三列，不为每行构建字典。
+    """
+    with open(fail_log_path, 'r', newline='', encoding='utf-8-sig') as f: # Excel 另存的“CSV UTF-8”带 BOM
+        reader = csv.reader(f)
+        header = next(reader, None)
+        rows = list(reader) if header else []
+    if not header:
+        logger_obj.warning(f"失败日志 '{fail_log_path}' 为空。")
+        write_csv_header(fail_log_path, FAIL_LOG_COLUMNS)
+        return set(), set(), set()
+    if 'ID' not in header:
+        logger_obj.warning(f"失败日志 '{fail_log_path}' 中缺少 'ID' 列。")
+        return set(), set(), set()
+
+    def column(row, name):
+        """按列名取值，列不存在或该行字段不足时返回空字符串"""
+        index = column_index.get(name)
+        return row[index] if index is not None and index < len(row) else ''
+
+    column_index = {name: i for i, name in enumerate(header)}
+    if 'error_type' not in column_index:
+        # 旧格式：从 'Reason' 列推断 NO_PANOID_FOUND，并把文件迁移为包含 'error_type' 列的新格式
+        logger_obj.warning(f"失败日志 '{fail_log_path}' 中缺少 'error_type' 列。所有历史失败将被视为可重试（除了明确的NO_PANOID_FOUND）。")
+        rows = [
+            [column(row, 'ID'), column(row, 'Reason'),
+             ERROR_TYPE_NO_PANOID_FOUND if "No panoId" in column(row, 'Reason') else ERROR_TYPE_GENERAL_EXCEPTION]
+            for row in rows
+        ]
+        with open(fail_log_path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(FAIL_LOG_COLUMNS)
+            writer.writerows(rows)
+        column_index = {name: i for i, name in enumerate(FAIL_LOG_COLUMNS)}
+        logger_obj.info(f"失败日志 '{fail_log_path}' 已迁移为包含 'error_type' 列的新格式。")
+
+    all_failed_ids = set()
+    permanent_failed_ids = set()
+    seen_keys = set()
+    for row in rows:
+        point_id = column(row, 'ID')
+        if not point_id:
+            continue
+        error_type = column(row, 'error_type')
+        all_failed_ids.add(point_id)
+        if error_type in PERMANENT_SKIP_ERROR_TYPES:
+            permanent_failed_ids.add(point_id)
+        seen_keys.add((point_id, column(row, 'Reason'), error_type))
+    return all_failed_ids, permanent_failed_ids, seen_keys
+
+def write_csv_header(csv_path, columns):
+    """创建（或清空）CSV 文件，只写入表头"""
+    with open(csv_path, 'w', newline='', encoding='utf-8') as f:
+        csv.writer(f).writerow(columns)
+
+class CsvLogWriter:
+    """
+    成功日志和失败日志的追加写入器。
+    启动时打开一次日志并保持打开，每条记录产生时追加一行，
+    代替每批次读取整个日志、合并去重后再整体重写；去重用启动时加载的记录集合做哈希查找，
+    已在日志中的记录（失败日志为 (ID, Reason, error_type)，成功日志为 (ID,)）不会重复写入。
+    去重在调用方线程（主线程）中完成，新记录放入队列，由后台写入线程格式化并写入 1 MB 的文件缓冲区，
+    累计 flush_every 条或距上次落盘超过 flush_interval 秒时再写入磁盘，主线程不会因写文件而停顿。
+    批次结束 (flush) 和关闭 (close) 时也会落盘。record/record_batch/flush/close 只在主线程中调用。
+    写入线程遇到错误（如磁盘已满、文件被其他程序锁定）时保存异常并退出，由下一次 flush 抛出，close 时记录到日志。
+    """
+    _FLUSH = object() # 队列中的落盘标记；None 为结束标记
+
+    def __init__(self, log_path, seen_keys, logger_obj, flush_every=500, flush_interval=2.0):
+        """
+        Args:
+            log_path (str): 日志路径（表头已存在）。
+            seen_keys (set): 日志中已有记录的元组集合，会被就地更新。
+            logger_obj (logging.Logger): 关闭时报告写入错误的日志器。
+            flush_every (int): 累计多少条未落盘的记录后写入磁盘。
+            flush_interval (float): 未落盘的记录最多保留的秒数。
+        """
+        self.log_path = log_path
+        self.seen_keys = seen_keys
+        self.logger = logger_obj
+        self.error = None # 写入线程遇到的异常
+        self.error_reported = False
+        self.file = open(log_path, 'a', newline='', encoding='utf-8', buffering=1 << 20) # 在主线程中打开，打开失败时直接抛出
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.pending = queue.SimpleQueue() # 待写入的记录列表
+        self.thread = threading.Thread(target=self._write_loop, name="csv-log-writer", daemon=True)
+        self.thread.start()
+
+    def _write_loop(self):
+        """后台写入线程：依次写入队列中的记录，按条数、时间间隔或落盘标记把缓冲区写入磁盘"""
+        writer = csv.writer(self.file)
+        unflushed = 0 # 缓冲区中尚未落盘的记录数
+        last_flush = monotonic()
+        try:
+            while True:
+                try:
+                    rows = self.pending.get(timeout=self.flush_interval)
+                except queue.Empty:
+                    rows = self._FLUSH # 空闲超过 flush_interval 秒，把已缓冲的记录落盘
+                if rows is None:
+                    break
+                if rows is not self._FLUSH:
+                    writer.writerows(rows)
+                    unflushed += len(rows)
+                if unflushed and (rows is self._FLUSH or unflushed >= self.flush_every or monotonic() - last_flush >= self.flush_interval):
+                    self.file.flush()
+                    unflushed = 0
+                    last_flush = monotonic()
+            self.file.close() # 关闭前写入剩余记录
+        except Exception as e:
+            self.error = e # 交给主线程在 flush/close 时报告，之后的记录不再写入
+            try:
+                self.file.close()
+            except Exception:
+                pass # 缓冲区中的记录同样无法写入，错误已保存
+
+    def record(self, *fields):
+        """追加一条记录（各列的值），已存在的相同记录会被跳过。返回是否实际写入。"""
+        key = tuple(map(str, fields))
+        if key in self.seen_keys:
+            return False
+        self.seen_keys.add(key)
+        self.pending.put((key,))
+        return True
+
+    def record_batch(self, point_ids, *fields):
+        """
+        为一批点位追加除 ID 外各列都相同的记录（例如整批 PanoIDs 请求失败时），一次写入所有新记录。
+
+        Args:
+            point_ids (list): 点位 ID 列表（字符串）。
+            *fields: ID 之后各列的值（失败日志为失败原因和错误类型）。
+        """
+        fields = tuple(map(str, fields))
+        new_keys = [key for key in ((point_id,) + fields for point_id in point_ids) if key not in self.seen_keys]
+        self.seen_keys.update(new_keys)
+        self.pending.put(new_keys)
+        self.pending.put(self._FLUSH) # 整批失败较少发生，直接落盘
+
+    def flush(self):
+        """
+        通知写入线程将已提交的记录写入磁盘（不等待完成）。
+
+        Raises:
+            OSError: 写入线程此前写入日志失败，已提交的记录没有全部写入。
+        """
+        if self.error is not None:
+            self.error_reported = True
+            raise OSError(f"写入日志 {self.log_path} 失败，部分记录未能保存: {self.error}") from self.error
+        if self.thread.is_alive():
+            self.pending.put(self._FLUSH)
+
+    def close(self):
+        """写入剩余记录并关闭日志文件，等待写入线程结束；写入失败时记录错误（在 finally 中调用，不抛出异常）"""
+        if self.thread.is_alive():
+            self.pending.put(None)
+            self.thread.join()
+        if self.error is not None and not self.error_reported:
+            self.error_reported = True
+            self.logger.error(f"写入日志 {self.log_path} 失败，部分记录未能保存: {self.error}")
+
+def main():
+    """
+    下载程序入口：读取 configuration.ini，按批次获取 PanoID、下载并拼接瓦片，记录成功和失败日志。
+    运行状态都是函数内的局部变量，其他脚本可以导入本模块后在同一进程中调用 main()，无需重新启动解释器。
+    """
     # --- 阶段1: 程序启动时的基础日志配置 ---
     # 在主程序的最早阶段设置一个临时的、仅输出到控制台的日志器。
     # 这确保了即使在读取配置文件等早期步骤中发生错误，也有日志输出。
@@ -249,22 +1232,16 @@ if __name__ == "__main__":
     # 设置 propagate 为 False，防止日志消息传递给根日志器，避免重复输出到控制台。
     logger.propagate = False 
 
-    # tqdm 全局锁，用于多线程环境下的安全输出
-    tqdm.set_lock(threading.RLock())
-    thread_local_storage = threading.local() # 用于线程特定的数据，如果需要的话
-
     try:
         print("程序启动...") # 使用 print 确保这条消息总能被用户看到
         logger.info("程序启动，正在读取配置文件。") # 这条会进入临时日志器
 
-        config = ConfigParser()
         if not os.path.exists('configuration.ini'):
             print("❌ 错误：配置文件 'configuration.ini' 未找到。请创建该文件。")
             logger.error("配置文件 'configuration.ini' 未找到，程序将退出。") # 这条会进入临时日志器
-            input("\n按回车键关闭...")
-            exit()
-        with open('configuration.ini', 'r', encoding='utf-8') as f:
-            config.read_file(f)
+            return
+        # 读取配置文件；文件未修改时直接使用上次的解析缓存
+        config = load_config_cached('configuration.ini')
 
         # 从配置文件中读取所有路径
         CSV_PATH = config['PATHS']['CSV_PATH']
@@ -302,8 +1279,12 @@ if __name__ == "__main__":
         BATCH_SIZE = int(config['PARAMS']['BATCH_SIZE'])
         NUM_BATCHES = int(config['PARAMS']['NUM_BATCHES'])
         RETRY_FAILED_POINTS = config.getboolean('PARAMS', 'RETRY_FAILED_POINTS', fallback=False)
-        MAX_POINT_WORKERS = config.getint('PARAMS', 'MAX_POINT_WORKERS', fallback=5)
+        MAX_POINT_WORKERS = config.getint('PARAMS', 'MAX_POINT_WORKERS', fallback=5) or default_point_workers() # 0 表示自动选择
+        ENCODE_WORKERS = config.getint('PARAMS', 'ENCODE_WORKERS', fallback=0) # JPEG 编码进程数，0 表示在点位线程内编码
         logger.info(f"参数加载：BATCH_SIZE={BATCH_SIZE}, NUM_BATCHES={NUM_BATCHES}, RETRY_FAILED_POINTS={RETRY_FAILED_POINTS}, MAX_POINT_WORKERS={MAX_POINT_WORKERS}")
+        if BATCH_SIZE < MAX_POINT_WORKERS * 2:
+            # 每批次末尾只剩少数慢点位时其余线程空闲，批次越小这段空闲占比越大
+            logger.warning(f"BATCH_SIZE ({BATCH_SIZE}) 小于 MAX_POINT_WORKERS 的 2 倍 ({MAX_POINT_WORKERS * 2})，批次末尾会有较多线程空闲，建议增大 batch_size。")
 
         ZOOM = int(config['TILES']['ZOOM'])
         TILE_SIZE = int(config['TILES']['TILE_SIZE'])
@@ -318,73 +1299,98 @@ if __name__ == "__main__":
         print(f"🧵 点位处理并发线程数: {MAX_POINT_WORKERS}")
         logger.info(f"点位处理并发线程数: {MAX_POINT_WORKERS}")
 
+        # 创建所有线程共享的 HTTP 会话，连接池大小与同时进行的瓦片请求数一致
+        HTTP_SESSION = create_http_session(pool_connections=MAX_POINT_WORKERS, pool_maxsize=MAX_POINT_WORKERS * TILE_FETCH_WORKERS)
+        if httpx is not None:
+            logger.info(f"HTTP/2 会话已创建 (httpx)，最大连接数: {MAX_POINT_WORKERS}")
+        else:
+            logger.info(f"HTTP 会话已创建，连接池大小: {MAX_POINT_WORKERS * TILE_FETCH_WORKERS}")
+
+        # 创建所有瓦片下载线程共享的令牌桶，允许 MAX_POINT_WORKERS 个请求的突发。
+        # SLEEPTIME 保持原来“每个下载线程每 SLEEPTIME 秒一个请求”的含义，整体速率为 MAX_POINT_WORKERS / SLEEPTIME 次/秒，
+        # 已有配置文件的请求速率不会因改用共享限速器而下降；SLEEPTIME 为 0 时不限速
+        TILE_REQUEST_RATE = MAX_POINT_WORKERS / SLEEPTIME if SLEEPTIME > 0 else None
+        TILE_RATE_LIMITER = TokenBucket(rate=TILE_REQUEST_RATE, burst=MAX_POINT_WORKERS)
+        # 点位处理线程池在整个运行期间复用，不再每个批次重新创建和销毁线程
+        POINT_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_POINT_WORKERS, thread_name_prefix="point")
+        # 创建全局共享的瓦片下载线程池，所有点位线程的瓦片请求都提交到这里
+        TILE_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_POINT_WORKERS * TILE_FETCH_WORKERS, thread_name_prefix="tile")
+        # PanoIDs 请求线程池：下一批次的 PanoIDs 在当前批次下载瓦片时提前请求
+        PANOID_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix="panoid")
+        # 按需创建 JPEG 编码进程池，绕开 GIL 让编码在多个 CPU 核心上并行
+        ENCODE_EXECUTOR = None
+        if ENCODE_WORKERS > 0:
+            if shared_memory is None:
+                logger.warning("当前 Python 版本不支持 multiprocessing.shared_memory，编码进程池未启用，将在点位线程内编码。")
+            else:
+                # 此时进程中已有日志、PanoIDs 预取等线程，fork 出的子进程可能继承被其他线程持有的锁而死锁，统一使用 spawn 启动
+                ENCODE_EXECUTOR = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=ENCODE_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+                print(f"🧮 JPEG 编码进程数: {ENCODE_WORKERS}")
+                logger.info(f"JPEG 编码进程池已创建，进程数: {ENCODE_WORKERS}")
+        logger.info(f"瓦片请求限速：{'不限速' if TILE_REQUEST_RATE is None else f'{TILE_REQUEST_RATE:.2f} 次/秒'}，突发上限 {MAX_POINT_WORKERS}")
+
 
         # 创建保存图像的目录，如果不存在
         os.makedirs(SAVE_DIR, exist_ok=True)
         logger.info(f"保存目录 '{SAVE_DIR}' 已确认/创建。")
         
         # 读取 API Key
-        if not os.path.exists(API_KEY_PATH):
+        if not path_exists_cached(API_KEY_PATH):
             logger.error(f"API Key 文件 '{API_KEY_PATH}' 未找到。")
             print(f"❌ 错误：API Key 文件 '{API_KEY_PATH}' 未找到。")
-            input("\n按回车键关闭...")
-            exit()
+            return
         with open(API_KEY_PATH, 'r') as f:
             API_KEY = f.readline().strip()
         logger.info(f"API Key 从 '{API_KEY_PATH}' 加载成功。")
 
+        # 优先复用上次运行缓存且仍在有效期内的会话 Token
+        SESSION_TOKEN = load_cached_session_token(SESSION_TOKEN_CACHE_PATH, API_KEY)
+        session_token_from_cache = SESSION_TOKEN is not None
+        if session_token_from_cache:
+            logger.info(f"使用缓存的 Session Token: {SESSION_TOKEN[:10]}...")
+        else:
+            # 在后台线程中提前发出创建会话 Token 的请求，使这次网络往返与读取日志、点位 CSV 重叠进行
+            logger.info("尝试创建街景会话 Token...")
+            startup_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+            session_future = startup_executor.submit(create_session_token, HTTP_SESSION, API_KEY, logger)
+            startup_executor.shutdown(wait=False) # 不再提交其他任务，线程在请求完成后自动退出
+
         # 加载已成功下载的ID，用于跳过已完成的任务
         downloaded_ids = set()
-        if os.path.exists(LOG_PATH):
+        if path_exists_cached(LOG_PATH):
             try:
-                log_content_df = pd.read_csv(LOG_PATH)
-                if 'ID' in log_content_df.columns:
-                    downloaded_ids = set(log_content_df['ID'].dropna().astype(str))
-                    logger.info(f"从 '{LOG_PATH}' 加载已成功下载 {len(downloaded_ids)} 个ID。")
-                else: logger.warning(f"成功日志 '{LOG_PATH}' 中缺少 'ID' 列。")
-            except pd.errors.EmptyDataError: logger.warning(f"成功日志 '{LOG_PATH}' 为空。")
+                downloaded_ids = load_success_ids(LOG_PATH, logger)
+                logger.info(f"从 '{LOG_PATH}' 加载已成功下载 {len(downloaded_ids)} 个ID。")
             except Exception as e_log: logger.error(f"读取成功日志 '{LOG_PATH}' 失败: {e_log}", exc_info=True)
         else:
-            pd.DataFrame(columns=['ID']).to_csv(LOG_PATH, index=False)
+            write_csv_header(LOG_PATH, ['ID'])
+            clear_path_cache() # 新建了文件，目录列表缓存失效
             logger.info(f"'{LOG_PATH}' 不存在，已创建空的成功日志文件。")
 
-        # failed_df_list 用于收集当前运行批次中产生的失败记录
-        failed_df_list = []
-        
         # 初始时从文件加载历史失败记录，用于构建 ids_to_skip_processing 集合
         initial_failed_ids_from_file = set() # 存储所有历史失败的ID
         permanent_failed_ids_from_file = set() # 存储被判断为永久失败的ID (即重试模式下也要跳过的ID)
+        fail_log_seen_keys = set() # 失败日志中已有的 (ID, Reason, error_type)，追加新记录时用于去重
 
-        if os.path.exists(FAIL_LOG_PATH):
+        if path_exists_cached(FAIL_LOG_PATH):
             try:
-                temp_failed_df = pd.read_csv(FAIL_LOG_PATH)
-                if not temp_failed_df.empty and 'ID' in temp_failed_df.columns:
-                    temp_failed_df['ID'] = temp_failed_df['ID'].astype(str)
-                    initial_failed_ids_from_file = set(temp_failed_df['ID'].unique())
-
-                    # 检查失败日志文件是否包含 'error_type' 列（用于兼容旧格式）
-                    if 'error_type' in temp_failed_df.columns:
-                        # 如果存在 'error_type' 列，则根据该列判断哪些是永久性失败
-                        permanent_failed_df = temp_failed_df[temp_failed_df['error_type'].isin(PERMANENT_SKIP_ERROR_TYPES)]
-                        permanent_failed_ids_from_file = set(permanent_failed_df['ID'].unique())
-                        logger.info(f"从 '{FAIL_LOG_PATH}' 初始加载 {len(permanent_failed_ids_from_file)} 个唯一永久失败ID。")
-                    else:
-                        # 如果缺少 'error_type' 列，则发出警告，并尝试从 'Reason' 列推断 'NO_PANOID_FOUND'
-                        logger.warning(f"失败日志 '{FAIL_LOG_PATH}' 中缺少 'error_type' 列。所有历史失败将被视为可重试（除了明确的NO_PANOID_FOUND）。")
-                        no_panoid_from_reason = temp_failed_df[temp_failed_df['Reason'].str.contains("No panoId", na=False)]['ID'].unique()
-                        permanent_failed_ids_from_file.update(no_panoid_from_reason)
-                        logger.info(f"从旧失败日志的 Reason 推断出 {len(no_panoid_from_reason)} 个 NO_PANOID_FOUND。")
-
+                initial_failed_ids_from_file, permanent_failed_ids_from_file, fail_log_seen_keys = load_fail_log(FAIL_LOG_PATH, logger)
+                logger.info(f"从 '{FAIL_LOG_PATH}' 初始加载 {len(permanent_failed_ids_from_file)} 个唯一永久失败ID。")
                 logger.info(f"从 '{FAIL_LOG_PATH}' 初始加载 {len(initial_failed_ids_from_file)} 个唯一失败ID。")
-            except pd.errors.EmptyDataError:
-                logger.warning(f"失败日志 '{FAIL_LOG_PATH}' 为空。")
             except Exception as e_fail_log:
                 logger.error(f"读取失败日志 '{FAIL_LOG_PATH}' 失败: {e_fail_log}", exc_info=True)
         else:
             # 如果失败日志文件不存在，创建一个新的空文件，并包含所有列
-            pd.DataFrame(columns=['ID', 'Reason', 'error_type']).to_csv(FAIL_LOG_PATH, index=False)
+            write_csv_header(FAIL_LOG_PATH, FAIL_LOG_COLUMNS)
+            clear_path_cache()
             logger.info(f"'{FAIL_LOG_PATH}' 不存在，已创建空的失败日志文件。")
 
+        # 失败记录在产生时直接追加写入失败日志
+        fail_log = CsvLogWriter(FAIL_LOG_PATH, fail_log_seen_keys, logger)
+        # 成功日志同样在成功时直接追加，已记录的 ID 不会重复写入（例如点位 CSV 中有重复 ID 时）
+        success_log = CsvLogWriter(LOG_PATH, {(point_id,) for point_id in downloaded_ids}, logger)
+
         # 构建最终需要跳过的ID集合
         # 总是跳过已成功下载的ID
         ids_to_skip_processing = set(downloaded_ids)
@@ -399,86 +1405,57 @@ if __name__ == "__main__":
 
         logger.info(f"总计将明确跳过 {len(ids_to_skip_processing)} 个ID。")
 
-        logger.info("尝试创建街景会话 Token...")
-        session_payload = {"mapType": "streetview", "language": "en-US", "region": "US"}
-        try:
-            # 发送请求创建会话 Token
-            session_response = requests.post(f"https://tile.googleapis.com/v1/createSession?key={API_KEY}", headers={"Content-Type": "application/json"}, json=session_payload, timeout=15)
-            
-            if session_response.status_code == 200:
-                # 成功获取 Token
-                SESSION_TOKEN = session_response.json().get("session")
-                if not SESSION_TOKEN:
-                    error_msg = f"无法获取 session token，响应内容：{session_response.text}"
-                    logger.error(error_msg)
-                    print(f"❌ {error_msg}") # 在控制台显示错误，因为这是一个可能导致程序无法继续的严重错误
-                    raise Exception("无法获取 session token")
-                logger.info(f"成功获取 Session Token: {SESSION_TOKEN[:10]}...")
-            else:
-                # Session Token 请求失败（非 200 状态码）
-                error_detail = ""
-                try:
-                    error_json = session_response.json()
-                    error_detail = error_json.get("error", {}).get("message", "") or error_json.get("message", "")
-                except json.JSONDecodeError:
-                    error_detail = session_response.text
-
-                error_reason = f"创建 Session Token 请求失败。状态码: {session_response.status_code}, 消息: {error_detail[:200]}..."
-                logger.error(error_reason) # 记录到文件和控制台 (因为是 ERROR 级别)
-                print(f"❌ {error_reason}") # 确保在控制台显示给用户
-
-                # 根据状态码判断并抛出特定异常
-                if session_response.status_code == 401 or session_response.status_code == 403:
-                    raise Exception(f"创建 Session Token 失败: API Key 无效或权限不足 ({error_reason})")
-                elif session_response.status_code == 429:
-                    raise Exception(f"创建 Session Token 失败: 速率限制，请稍后再试 ({error_reason})")
-                elif session_response.status_code >= 500:
-                    raise Exception(f"创建 Session Token 失败: 服务器内部错误，可能暂时性 ({error_reason})")
-                elif session_response.status_code == 400:
-                    raise Exception(f"创建 Session Token 失败: 请求参数错误 ({error_reason})")
-                else:
-                    raise Exception(f"创建 Session Token 失败: 未知HTTP状态码 ({error_reason})")
-        except requests.exceptions.Timeout as req_e:
-            logger.error(f"创建 Session Token 请求超时: {req_e}", exc_info=True)
-            print(f"❌ 创建 Session Token 请求超时: {req_e}")
-            raise Exception(f"创建 Session Token 请求超时: {req_e}")
-        except requests.exceptions.ConnectionError as req_e:
-            logger.error(f"创建 Session Token 连接错误: {req_e}", exc_info=True)
-            print(f"❌ 创建 Session Token 连接错误: {req_e}")
-            raise Exception(f"创建 Session Token 连接错误: {req_e}")
-        except requests.exceptions.RequestException as req_e:
-            logger.error(f"创建 Session Token 请求发生未知异常: {req_e}", exc_info=True)
-            print(f"❌ 创建 Session Token 请求发生未知异常: {req_e}")
-            raise Exception(f"创建 Session Token 请求发生未知异常: {req_e}")
-        except Exception as e_session_general:
-            logger.error(f"创建 Session Token 发生意外错误: {e_session_general}", exc_info=True)
-            print(f"❌ 创建 Session Token 发生意外错误: {e_session_general}")
-            raise Exception(f"创建 Session Token 发生意外错误: {e_session_general}")
-
-
         # 检查点位 CSV 文件是否存在
-        if not os.path.exists(CSV_PATH):
+        if not path_exists_cached(CSV_PATH):
             logger.error(f"点位CSV文件 '{CSV_PATH}' 未找到。")
             print(f"❌ 错误：点位CSV文件 '{CSV_PATH}' 未找到。")
-            input("\n按回车键关闭...")
-            exit()
-        all_df = pd.read_csv(CSV_PATH)
+            return
+        # 只读取用到的 ID/Lat/Lng 三列
+        all_df = read_points_csv(CSV_PATH)
         if 'ID' not in all_df.columns:
             logger.error(f"点位CSV文件 '{CSV_PATH}' 中缺少 'ID' 列。")
             print(f"❌ 错误：点位CSV文件 '{CSV_PATH}' 中缺少 'ID' 列。")
-            input("\n按回车键关闭...")
-            exit()
-        all_df['ID'] = all_df['ID'].astype(str) # 确保 ID 列是字符串类型
+            return
+        # 旧版本写入的日志 ID 可能与当前按文本读取的 ID 形式不同，只在日志中有对不上的 ID 时才做一次兼容匹配
+        unmatched_log_ids = ids_to_skip_processing.difference(all_df['ID'].dropna())
+        if unmatched_log_ids:
+            legacy_matched_ids = match_legacy_ids(CSV_PATH, all_df['ID'], unmatched_log_ids)
+            if legacy_matched_ids:
+                logger.info(f"按旧版本 ID 格式匹配到日志中的 {len(legacy_matched_ids)} 个点位，将一并跳过。")
+                ids_to_skip_processing.update(legacy_matched_ids)
+        missing_id_rows = all_df['ID'].isna()
+        if missing_id_rows.any():
+            # ID 为空的行无法命名输出文件，也无法记录到日志，直接跳过；其余 ID 均为字符串，后续不再逐个 str() 转换
+            logger.warning(f"点位CSV文件 '{CSV_PATH}' 中有 {int(missing_id_rows.sum())} 行缺少 ID，已跳过。")
+            all_df = all_df[~missing_id_rows].reset_index(drop=True)
         logger.info(f"从 '{CSV_PATH}' 加载 {len(all_df)} 个总点位。")
+
+        if not session_token_from_cache:
+            # 等待启动时提前发出的创建会话请求返回（请求异常会在此处重新抛出）
+            SESSION_TOKEN, session_expiry = session_future.result()
+            save_session_token(SESSION_TOKEN_CACHE_PATH, API_KEY, SESSION_TOKEN, session_expiry)
         
-        current_run_log_list = [] # 存储当前运行中成功下载的ID，用于更新成功日志
+        # 待处理点位：启动时根据跳过集合计算一次，之后每批只增量更新，不再每批把不断增长的跳过集合重新做一遍 isin；
+        # 本次运行中已处理的点位由 pending_points 在取出批次时标记，跳过集合之后不再使用
+        pending_points = PendingPoints(all_df, ids_to_skip_processing)
+
+        # 检查点位数据是否包含经纬度列
+        if not all(col in all_df.columns for col in ['Lat', 'Lng']):
+            logger.error("点位数据中缺少 'Lat' 或 'Lng' 列。请检查CSV文件。") # 记录到文件和控制台
+            print("❌ 错误：点位数据中缺少 'Lat' 或 'Lng' 列。") # 控制台输出
+            upcoming_batches = deque()
+        else:
+            upcoming_batches = deque(prefetch_batches(PANOID_EXECUTOR, HTTP_SESSION, SESSION_TOKEN, API_KEY, pending_points, BATCH_SIZE, NUM_BATCHES, logger)) # 第一组批次
+
+        consecutive_auth_failures = 0 # 连续因 401/403 失败的点位数
+        abort_run = False # 认证持续失败时置位，停止处理后续批次
 
         # 遍历批次进行处理
-        for batch_num in range(NUM_BATCHES):
-            logger.info(f"开始处理批次 {batch_num + 1}/{NUM_BATCHES}") # 这条信息会进入文件，不会进入控制台
-            
-            # 根据已跳过ID集合筛选当前批次要处理的点位
-            current_processing_df = all_df[~all_df['ID'].isin(list(ids_to_skip_processing))].head(BATCH_SIZE)
+        for batch_num in range(NUM_BATCHES if upcoming_batches else 0):
+            logger.info("开始处理批次 %d/%d", batch_num + 1, NUM_BATCHES) # 这条信息会进入文件
+
+            current_processing_df, panoid_futures, panoid_offset, panoid_session_token = upcoming_batches.popleft()
+            batch_ids = current_processing_df['ID'].tolist()
             
             if current_processing_df.empty:
                 print("🎉 所有符合条件的点位已处理完毕，无需再运行更多批次。") # 使用 print 确保用户看到
@@ -486,200 +1463,104 @@ if __name__ == "__main__":
                 break # 所有点位都已处理，退出批次循环
             
             print(f"\n🚀 正在处理第 {batch_num + 1}/{NUM_BATCHES} 批，共 {len(current_processing_df)} 个点位...") # 使用 print 确保用户看到
-            logger.info(f"批次 {batch_num + 1}：待处理点位数 {len(current_processing_df)}") # 这条信息会进入文件
+            logger.info("批次 %d：待处理点位数 %d", batch_num + 1, len(current_processing_df)) # 这条信息会进入文件
 
-            # 检查当前批次数据是否包含经纬度列
-            if not all(col in current_processing_df.columns for col in ['Lat', 'Lng']):
-                logger.error("当前批次点位数据中缺少 'Lat' 或 'Lng' 列。请检查CSV文件。") # 记录到文件和控制台
-                print("❌ 错误：当前批次点位数据中缺少 'Lat' 或 'Lng' 列。") # 控制台输出
-                continue # 跳过当前批次，进入下一批次
+            # 本组批次用完时，先提交下一组批次的 PanoIDs 请求，使其与本批次的瓦片下载重叠进行
+            if not upcoming_batches and batch_num + 1 < NUM_BATCHES:
+                upcoming_batches.extend(prefetch_batches(PANOID_EXECUTOR, HTTP_SESSION, SESSION_TOKEN, API_KEY, pending_points, BATCH_SIZE, NUM_BATCHES - batch_num - 1, logger))
 
-            # 准备请求 PanoIDs 的地理位置列表
-            locations = [{"lat": row["Lat"], "lng": row["Lng"]} for _, row in current_processing_df.iterrows()]
-            logger.debug(f"批次 {batch_num + 1}：请求 PanoIDs 的地点 (前5个): {locations[:5]}") # 这条信息只进入文件
-
-            # 请求 PanoIDs
-            panoid_url = f"https://tile.googleapis.com/v1/streetview/panoIds?session={SESSION_TOKEN}&key={API_KEY}"
-            pano_ids_data = [] # 存储 PanoID 响应数据
+            # 等待本批次的 PanoIDs 请求（已在上一批次下载瓦片期间提前发出）
             try:
-                response_pano_ids = requests.post(panoid_url, json={"locations": locations, "radius": 50}, timeout=20)
-                if response_pano_ids.status_code == 200:
-                    try:
-                        pano_ids_data = response_pano_ids.json().get("panoIds", [])
-                        logger.info(f"批次 {batch_num + 1}：成功获取 PanoIDs 响应。数量: {len(pano_ids_data)}") # 文件日志
-                        logger.debug(f"批次 {batch_num + 1}：获取到的 PanoIDs (部分): {pano_ids_data[:5]}") # 文件日志
-                    except json.JSONDecodeError: # JSON 解析失败
-                        error_reason = f"获取 PanoIDs 成功，但JSON解析失败。响应文本: {response_pano_ids.text[:200]}..."
-                        logger.error(f"批次 {batch_num + 1}：{error_reason}") # 文件和控制台日志
-                        # 将本批次所有点位标记为失败，并记录 JSON 解析错误类型
-                        for point_row_tuple in current_processing_df.itertuples(index=False):
-                            failed_df_list.append({"ID": str(point_row_tuple.ID), "Reason": error_reason, "error_type": ERROR_TYPE_PANOID_JSON_PARSE_ERROR})
-                            ids_to_skip_processing.add(str(point_row_tuple.ID)) # 标记为已处理（失败）
-                        continue # 跳过当前批次的瓦片下载，进入下一批次
-                else:
-                    # PanoIDs 请求失败（非 200 状态码）
-                    error_detail = ""
-                    try:
-                        error_json = response_pano_ids.json()
-                        error_detail = error_json.get("error", {}).get("message", "") or error_json.get("message", "")
-                    except json.JSONDecodeError:
-                        error_detail = response_pano_ids.text
-
-                    error_reason = f"获取 PanoIDs 请求失败。状态码: {response_pano_ids.status_code}, 消息: {error_detail[:200]}..."
-                    logger.error(f"批次 {batch_num + 1}：{error_reason}") # 文件和控制台日志
-                    
-                    # 根据状态码判断 PanoID 请求的错误类型
-                    current_batch_error_type = ERROR_TYPE_UNCLASSIFIED_HTTP_STATUS # 默认未知HTTP状态码
-                    if response_pano_ids.status_code == 400: # Bad Request
-                        current_batch_error_type = ERROR_TYPE_API_BAD_REQUEST
-                    elif response_pano_ids.status_code == 401 or response_pano_ids.status_code == 403: # Forbidden
-                        current_batch_error_type = ERROR_TYPE_API_AUTH_FORBIDDEN
-                    elif response_pano_ids.status_code == 429: # Too Many Requests
-                        current_batch_error_type = ERROR_TYPE_API_RATE_LIMIT
-                    elif 500 <= response_pano_ids.status_code < 600: # Server Error
-                        current_batch_error_type = ERROR_TYPE_API_SERVER_ERROR
-
-                    # 将本批次所有点位标记为相应的失败类型
-                    for point_row_tuple in current_processing_df.itertuples(index=False):
-                        failed_df_list.append({"ID": str(point_row_tuple.ID), "Reason": error_reason, "error_type": current_batch_error_type})
-                        ids_to_skip_processing.add(str(point_row_tuple.ID)) # 标记为已处理（失败）
-                    continue # 跳过当前批次的瓦片下载，进入下一批次
-
-            except requests.exceptions.Timeout as req_e_pano: # PanoIDs 请求超时
-                error_reason = f"获取 PanoIDs 请求超时: {req_e_pano}"
-                logger.error(f"批次 {batch_num + 1}：{error_reason}") # 文件和控制台日志
-                for point_row_tuple in current_processing_df.itertuples(index=False):
-                    failed_df_list.append({"ID": str(point_row_tuple.ID), "Reason": error_reason, "error_type": ERROR_TYPE_NETWORK_TIMEOUT})
-                    ids_to_skip_processing.add(str(point_row_tuple.ID))
-                continue # 跳过当前批次的瓦片下载
-            except requests.exceptions.ConnectionError as req_e_pano: # PanoIDs 连接错误
-                error_reason = f"获取 PanoIDs 连接错误: {req_e_pano}"
-                logger.error(f"批次 {batch_num + 1}：{error_reason}") # 文件和控制台日志
-                for point_row_tuple in current_processing_df.itertuples(index=False):
-                    failed_df_list.append({"ID": str(point_row_tuple.ID), "Reason": error_reason, "error_type": ERROR_TYPE_NETWORK_CONNECTION_ERROR})
-                    ids_to_skip_processing.add(str(point_row_tuple.ID))
-                continue
-            except requests.exceptions.RequestException as req_e_pano: # 其他 requests 异常
-                error_reason = f"获取 PanoIDs 请求发生未知异常: {req_e_pano}"
-                logger.error(f"批次 {batch_num + 1}：{error_reason}") # 文件和控制台日志
-                for point_row_tuple in current_processing_df.itertuples(index=False):
-                    failed_df_list.append({"ID": str(point_row_tuple.ID), "Reason": error_reason, "error_type": ERROR_TYPE_UNCLASSIFIED_REQUEST_ERROR})
-                    ids_to_skip_processing.add(str(point_row_tuple.ID))
-                continue
+                try:
+                    pano_ids_data = collect_pano_ids(panoid_futures)[panoid_offset:panoid_offset + len(batch_ids)]
+                except PanoIdRequestError as e_token:
+                    token_replaced = panoid_session_token != SESSION_TOKEN # 请求发出后 Token 已被重新创建
+                    if e_token.status_code not in (400, 401, 403) or not (session_token_from_cache or token_replaced):
+                        raise
+                    if not token_replaced:
+                        # 缓存的 Token 可能已在服务端失效：删除缓存，重新创建 Token
+                        logger.warning(f"批次 {batch_num + 1}：使用缓存的 Session Token 请求 PanoIDs 失败 (HTTP {e_token.status_code})，重新创建 Token 后重试。")
+                        invalidate_session_token(SESSION_TOKEN_CACHE_PATH)
+                        session_token_from_cache = False
+                        SESSION_TOKEN, session_expiry = create_session_token(HTTP_SESSION, API_KEY, logger)
+                        save_session_token(SESSION_TOKEN_CACHE_PATH, API_KEY, SESSION_TOKEN, session_expiry)
+                    # 用当前的 Token 重新请求一次（预取请求可能使用了已被替换的旧 Token）
+                    pano_ids_data = collect_pano_ids(submit_pano_id_requests(PANOID_EXECUTOR, HTTP_SESSION, SESSION_TOKEN, API_KEY, batch_locations(current_processing_df), logger))
+                if len(pano_ids_data) != len(batch_ids):
+                    # PanoIDs 按位置与点位对应，数量不一致时无法确定对应关系，整批记为失败，避免写入错位的结果
+                    raise ValueError(f"PanoID 数量 ({len(pano_ids_data)}) 与点位数 ({len(batch_ids)}) 不一致")
+                logger.info("批次 %d：成功获取 PanoIDs 响应。数量: %d", batch_num + 1, len(pano_ids_data)) # 文件日志
+                logger.debug("批次 %d：获取到的 PanoIDs (部分): %s", batch_num + 1, pano_ids_data[:5]) # 文件日志
+            except PanoIdRequestError as e_pano: # 请求失败、非 200 状态码或 JSON 解析失败
+                logger.error(f"批次 {batch_num + 1}：{e_pano.reason}") # 文件和控制台日志
+                # 将本批次所有点位记为相应的失败类型（取出批次时 pending_points 已将其标记为已处理）
+                fail_log.record_batch(batch_ids, e_pano.reason, e_pano.error_type)
+                continue # 跳过当前批次的瓦片下载，进入下一批次
             except Exception as e_pano_general: # 捕获其他通用异常
                 error_reason = f"获取 PanoIDs 发生意外错误: {e_pano_general}"
                 logger.error(f"批次 {batch_num + 1}：{error_reason}", exc_info=True) # 文件和控制台日志 (含堆栈信息)
-                for point_row_tuple in current_processing_df.itertuples(index=False):
-                    failed_df_list.append({"ID": str(point_row_tuple.ID), "Reason": error_reason, "error_type": ERROR_TYPE_GENERAL_EXCEPTION}) # 捕获通用异常
-                    ids_to_skip_processing.add(str(point_row_tuple.ID))
+                fail_log.record_batch(batch_ids, error_reason, ERROR_TYPE_GENERAL_EXCEPTION) # 捕获通用异常
                 continue
             
             print("📍 已获取 panoIds") # 使用 print
             results_this_batch_filenames = [] # 存储当前批次成功下载的文件信息
 
-            # 确保 pano_ids_data 长度与 current_processing_df 匹配
-            # Google API 通常会返回与请求 locations 数量相同的 panoIds 列表，
-            # 即使某些地点没有 panoId 也会用空字符串 "" 填充。
-            # 这里是为了以防万一 API 响应长度不匹配，用 None 补齐。
-            if len(pano_ids_data) != len(locations):
-                logger.warning(f"批次 {batch_num + 1}: PanoID数量({len(pano_ids_data)})与地点数({len(locations)})不匹配。将尝试按地点数迭代，PanoID不足处会为None。") # 文件和控制台日志
-                pano_ids_data.extend([None] * (len(locations) - len(pano_ids_data)))
-
-
+            # 整批共用一个瓦片进度条（代替每个点位各自的进度条），并降低刷新频率
+            batch_total_tiles = len(batch_ids) * TILE_COLS * TILE_ROWS
             # 使用线程池并发处理每个点位
-            with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_POINT_WORKERS) as executor:
+            with tqdm(total=batch_total_tiles, desc=f"批次 {batch_num + 1} 瓦片", position=1, leave=False, mininterval=0.2, miniters=50) as tile_pbar:
                 future_to_point = {} # 映射 Future 对象到点位 ID
-                for i, point_row_tuple in enumerate(current_processing_df.itertuples(index=False)):
-                    current_pano_id = pano_ids_data[i] if i < len(pano_ids_data) else None
-                    
+                for point_id_str, current_pano_id in zip(batch_ids, pano_ids_data): # 数量已在上面校验一致
                     # 提交处理单个点位的任务到线程池
-                    future = executor.submit(process_single_point, 
-                                            point_row_tuple, current_pano_id, API_KEY, SESSION_TOKEN, 
+                    future = POINT_EXECUTOR.submit(process_single_point, 
+                                            HTTP_SESSION, TILE_RATE_LIMITER, TILE_EXECUTOR, ENCODE_EXECUTOR, tile_pbar, point_id_str, current_pano_id, API_KEY, SESSION_TOKEN, 
                                             ZOOM, TILE_COLS, TILE_ROWS, TILE_SIZE, 
-                                            SLEEPTIME, SAVE_DIR, logger, thread_local_storage)
-                    future_to_point[future] = str(point_row_tuple.ID) # 使用原始ID作为键
+                                            SLEEPTIME, SAVE_DIR, logger)
+                    future_to_point[future] = point_id_str # 使用原始ID作为键
 
                 # 包装 concurrent.futures.as_completed，以便显示总体进度条
-                for future in tqdm(concurrent.futures.as_completed(future_to_point), total=len(future_to_point), desc=f"处理批次 {batch_num + 1} 点位"):
+                for future in tqdm(concurrent.futures.as_completed(future_to_point), total=len(future_to_point), desc=f"处理批次 {batch_num + 1} 点位", position=0):
                     point_id_processed = future_to_point[future] # 获取已处理点位的 ID
+                    if future.cancelled():
+                        continue # 认证持续失败后被取消的点位，不做记录，下次运行时重新处理
                     try:
                         result = future.result() # 获取线程的返回结果
+                        if result.get('error_type') == ERROR_TYPE_API_AUTH_FORBIDDEN:
+                            consecutive_auth_failures += 1
+                        elif result['status'] == 'success':
+                            consecutive_auth_failures = 0
+                        if consecutive_auth_failures >= AUTH_FAILURE_ABORT_THRESHOLD and not abort_run:
+                            abort_run = True
+                            for pending_future in future_to_point:
+                                pending_future.cancel() # 取消尚未开始的点位，正在运行的点位会很快因同样的错误结束
+                            logger.error(f"批次 {batch_num + 1}：连续 {consecutive_auth_failures} 个点位因 401/403 失败，API Key 或会话可能已失效，停止运行。")
+                            print(f"❌ 连续 {consecutive_auth_failures} 个点位因权限错误 (401/403) 失败，请检查 API Key 和 Tile API 权限。已停止处理剩余点位。")
                         if result['status'] == 'success':
-                            # 如果处理成功，记录到成功列表和已跳过ID集合
+                            # 如果处理成功，记录到批次结果和成功日志
                             results_this_batch_filenames.append({"ID": result['id'], "panoId": result['panoId'], "file": result['file']})
-                            current_run_log_list.append({"ID": result['id']})
-                            ids_to_skip_processing.add(result['id']) # 标记为已处理（成功）
+                            success_log.record(result['id'])
                         else: # status == 'failure'
-                            # 如果处理失败，记录到失败列表，并标记为已处理
+                            # 如果处理失败，记录到失败日志
                             reason = result.get('reason', '未知失败')
                             error_type = result.get('error_type', ERROR_TYPE_GENERAL_EXCEPTION) 
-                            failed_df_list.append({"ID": result['id'], "Reason": reason, "error_type": error_type})
-                            ids_to_skip_processing.add(result['id']) # 标记为已处理（失败）
+                            fail_log.record(result['id'], reason, error_type)
                     except Exception as exc: # 捕获线程执行过程中未被 process_single_point 捕获的异常
                         logger.error(f"点位ID {point_id_processed} 在线程中执行时产生未捕获异常: {exc}", exc_info=True) # 文件和控制台日志
-                        failed_df_list.append({"ID": point_id_processed, "Reason": f"线程中未捕获异常: {exc}", "error_type": ERROR_TYPE_GENERAL_EXCEPTION})
-                        ids_to_skip_processing.add(point_id_processed) # 标记为已处理（异常）
+                        fail_log.record(point_id_processed, f"线程中未捕获异常: {exc}", ERROR_TYPE_GENERAL_EXCEPTION)
             
-            # ===== 每批次结束时保存一次本批次产生的失败记录和批次结果 =====
-            if failed_df_list: # 如果当前运行的批次中产生了失败记录
-                temp_batch_failed_df = pd.DataFrame(failed_df_list)
-                # 读取旧的失败日志，合并当前批次产生的失败，去重后保存
-                if os.path.exists(FAIL_LOG_PATH):
-                    try:
-                        old_failed_df = pd.read_csv(FAIL_LOG_PATH)
-                        # 如果旧日志没有 'error_type' 列，则添加并填充默认值，确保合并后的DataFrame结构一致
-                        if 'error_type' not in old_failed_df.columns:
-                            old_failed_df['error_type'] = ERROR_TYPE_GENERAL_EXCEPTION # 默认值
-                            logger.warning(f"旧失败日志 '{FAIL_LOG_PATH}' 缺少 'error_type' 列，已添加并填充默认值。") # 文件和控制台日志
-                        
-                        if not old_failed_df.empty and 'ID' in old_failed_df.columns and 'Reason' in old_failed_df.columns:
-                             combined_failed_df = pd.concat([old_failed_df, temp_batch_failed_df], ignore_index=True)
-                        else: # 旧日志为空或格式不对
-                            combined_failed_df = temp_batch_failed_df
-                    except pd.errors.EmptyDataError: # 旧日志文件为空
-                        combined_failed_df = temp_batch_failed_df
-                    except Exception as e_read_old_fail: # 读取旧日志失败
-                        logger.error(f"读取旧失败日志 '{FAIL_LOG_PATH}' 失败: {e_read_old_fail}。将仅保存当前运行的失败记录。", exc_info=True) # 文件和控制台日志
-                        # print(f"❌ 读取旧失败日志 '{FAIL_LOG_PATH}' 失败: {e_read_old_fail}。将仅保存当前运行的失败记录。") # 如果希望控制台额外输出
-                        combined_failed_df = temp_batch_failed_df
-                else: # 旧失败日志不存在
-                    combined_failed_df = temp_batch_failed_df
-                
-                # 检查合并后的DataFrame是否包含所有必要的列，并去重保存
-                if 'ID' in combined_failed_df.columns and 'Reason' in combined_failed_df.columns and 'error_type' in combined_failed_df.columns:
-                    combined_failed_df['ID'] = combined_failed_df['ID'].astype(str)
-                    # 根据 'ID', 'Reason' 和 'error_type' 进行去重，保留最新的记录
-                    combined_failed_df.drop_duplicates(subset=['ID', 'Reason', 'error_type'], keep='last').to_csv(FAIL_LOG_PATH, index=False)
-                    logger.info(f"失败日志 '{FAIL_LOG_PATH}' 已更新。") # 文件日志
-                else:
-                    logger.error(f"无法更新失败日志，因为合并后的日志缺少必要的列 (ID, Reason, 或 error_type)。") # 文件和控制台日志
-                failed_df_list = [] # 清空当前运行的失败列表，避免重复添加
-
+            # ===== 每批次结束时保存批次结果（失败记录已在产生时写入失败日志） =====
             # 保存当前批次成功下载的文件列表
             if results_this_batch_filenames:
-                pd.DataFrame(results_this_batch_filenames).to_csv(os.path.join(SAVE_DIR, f'results_batch_{batch_num+1}.csv'), index=False)
-            logger.info(f"批次 {batch_num + 1} 处理完成。失败日志和批次结果已更新。") # 文件日志
-
-        # ===== 所有批次处理完成后，统一更新成功日志 =====
-        if current_run_log_list:
-            new_success_df = pd.DataFrame(current_run_log_list)
-            if os.path.exists(LOG_PATH):
-                try:
-                    old_log_df = pd.read_csv(LOG_PATH)
-                    if 'ID' not in old_log_df.columns: combined_log_df = new_success_df
-                    else: combined_log_df = pd.concat([old_log_df, new_success_df], ignore_index=True)
-                except pd.errors.EmptyDataError: combined_log_df = new_success_df
-                except Exception as e_read_old_log:
-                    logger.error(f"读取旧成功日志 '{LOG_PATH}' 失败: {e_read_old_log}。将仅保存当前运行的成功记录。", exc_info=True) # 文件和控制台日志
-                    # print(f"❌ 读取旧成功日志 '{LOG_PATH}' 失败: {e_read_old_log}。将仅保存当前运行的成功记录。") # 如果需要控制台额外输出
-                    combined_log_df = new_success_df
-            else: combined_log_df = new_success_df
-
-            if 'ID' in combined_log_df.columns:
-                combined_log_df['ID'] = combined_log_df['ID'].astype(str)
-                combined_log_df.drop_duplicates(subset=['ID'], keep='last').to_csv(LOG_PATH, index=False)
-                logger.info(f"成功日志 '{LOG_PATH}' 已更新。") # 文件日志
-            else: logger.error(f"无法更新成功日志，因为合并后的日志缺少 'ID' 列。") # 文件和控制台日志
+                # 每批只有几十到几百行，直接用 csv 模块写出，不构建 DataFrame
+                with open(os.path.join(SAVE_DIR, f'results_batch_{batch_num+1}.csv'), 'w', newline='', encoding='utf-8') as results_file:
+                    results_writer = csv.DictWriter(results_file, fieldnames=BATCH_RESULT_COLUMNS)
+                    results_writer.writeheader()
+                    results_writer.writerows(results_this_batch_filenames)
+            success_log.flush()
+            fail_log.flush() # 每批次结束时成功和失败记录全部落盘
+            logger.info("批次 %d 处理完成。成功日志、失败日志和批次结果已更新。", batch_num + 1) # 文件日志
+            if abort_run:
+                break # 认证持续失败，不再处理后续批次
 
         print("\n✅ 所有批次处理完成。") # 始终在控制台显示完成信息
         logger.info("所有批次处理完成。") # 文件日志
@@ -692,71 +1573,27 @@ if __name__ == "__main__":
             # 这种情况极少发生，意味着在基础 logger 初始化之前就发生了严重错误
             print("Logger 未初始化，详细错误信息如下：")
             traceback.print_exc() 
-
-        try: # 即使在异常情况下，也尝试保存已收集的失败和成功记录，防止数据丢失
-            if 'failed_df_list' in locals() and failed_df_list:
-                temp_failed_df_on_exit = pd.DataFrame(failed_df_list)
-                if os.path.exists(FAIL_LOG_PATH):
-                    try:
-                        old_failed_df = pd.read_csv(FAIL_LOG_PATH)
-                        if 'error_type' not in old_failed_df.columns:
-                            old_failed_df['error_type'] = ERROR_TYPE_GENERAL_EXCEPTION # 默认值
-                            # 此时 logger 必定不为 None，可以安全使用
-                            if logger: logger.warning(f"旧失败日志 '{FAIL_LOG_PATH}' 缺少 'error_type' 列，已添加并填充默认值。") # 文件和控制台日志
-                        
-                        if not old_failed_df.empty and 'ID' in old_failed_df.columns and 'Reason' in old_failed_df.columns:
-                            combined_failed_df = pd.concat([old_failed_df, temp_failed_df_on_exit], ignore_index=True)
-                        else:
-                            combined_failed_df = temp_failed_df_on_exit
-                    except pd.errors.EmptyDataError:
-                        combined_failed_df = temp_failed_df_on_exit
-                    except Exception as e_read_old_fail:
-                        print(f"读取旧失败日志 '{FAIL_LOG_PATH}' 失败: {e_read_old_fail}。将仅保存当前运行的失败记录。") # 控制台输出
-                        if logger: logger.error(f"读取旧失败日志 '{FAIL_LOG_PATH}' 失败: {e_read_old_fail}。将仅保存当前运行的失败记录。", exc_info=True) # 文件和控制台日志
-                        combined_failed_df = temp_failed_df_on_exit
-                else:
-                    combined_failed_df = temp_failed_df_on_exit
-
-                if 'ID' in combined_failed_df.columns and 'Reason' in combined_failed_df.columns and 'error_type' in combined_failed_df.columns:
-                    combined_failed_df['ID'] = combined_failed_df['ID'].astype(str)
-                    combined_failed_df.drop_duplicates(subset=['ID', 'Reason', 'error_type'], keep='last').to_csv(FAIL_LOG_PATH, index=False)
-                    if logger:
-                        logger.info("程序异常退出前，尝试保存当前收集的失败记录。") # 文件日志
-                else:
-                    print(f"❌ 在异常处理中保存失败日志失败：缺少必要的列。") # 控制台输出
-                    if logger: logger.error(f"在异常处理中保存失败日志失败：缺少必要的列。", exc_info=True) # 文件和控制台日志
-
-            if 'current_run_log_list' in locals() and current_run_log_list:
-                new_success_df = pd.DataFrame(current_run_log_list)
-                if os.path.exists(LOG_PATH):
-                    try:
-                        old_log_df = pd.read_csv(LOG_PATH)
-                        if 'ID' not in old_log_df.columns:
-                            combined_log_df = new_success_df
-                        else:
-                            combined_log_df = pd.concat([old_log_df, new_success_df], ignore_index=True)
-                    except pd.errors.EmptyDataError:
-                        combined_log_df = new_success_df
-                    except Exception as e_read_old_log:
-                        print(f"读取旧成功日志 '{LOG_PATH}' 失败: {e_read_old_log}。将仅保存当前运行的成功记录。") # 控制台输出
-                        if logger: logger.error(f"读取旧成功日志 '{LOG_PATH}' 失败: {e_read_old_log}。将仅保存当前运行的成功记录。", exc_info=True) # 文件和控制台日志
-                        combined_log_df = new_success_df
-                else:
-                    combined_log_df = new_success_df
-
-                if 'ID' in combined_log_df.columns:
-                    combined_log_df['ID'] = combined_log_df['ID'].astype(str)
-                    combined_log_df.drop_duplicates(subset=['ID'], keep='last').to_csv(LOG_PATH, index=False)
-                    if logger:
-                        logger.info("程序异常退出前，尝试保存当前收集的成功记录。") # 文件日志
-                else:
-                    print(f"❌ 在异常处理中保存成功日志失败：缺少必要的列。") # 控制台输出
-                    if logger: logger.error(f"在异常处理中保存成功日志失败：缺少必要的列。", exc_info=True) # 文件和控制台日志
-
-        except Exception as log_save_e:
-            print(f"❌ 在异常处理中保存日志时也发生错误: {log_save_e}") # 控制台输出
-            if logger: logger.error(f"在异常处理中保存日志时也发生错误: {log_save_e}", exc_info=True) # 文件和控制台日志
     finally:
+        if 'success_log' in locals():
+            success_log.close() # 关闭成功日志文件
+        if 'fail_log' in locals():
+            fail_log.close() # 关闭失败日志文件
+        if 'POINT_EXECUTOR' in locals():
+            POINT_EXECUTOR.shutdown(cancel_futures=True) # 关闭点位处理线程池
+        if 'TILE_EXECUTOR' in locals():
+            TILE_EXECUTOR.shutdown() # 关闭瓦片下载线程池
+        if 'HTTP_SESSION' in locals():
+            HTTP_SESSION.close() # 关闭 HTTP 会话中的连接
+        if 'PANOID_EXECUTOR' in locals():
+            PANOID_EXECUTOR.shutdown(cancel_futures=True) # 关闭 PanoIDs 请求线程池，丢弃未开始的预取请求
+        if 'ENCODE_EXECUTOR' in locals() and ENCODE_EXECUTOR is not None:
+            ENCODE_EXECUTOR.shutdown() # 关闭编码进程池
         # 程序结束时，如果 logger 已经初始化，则记录结束信息
-        if logger: logger.info("程序结束。\n---------------------------------------\n") # 文件日志
-        input("\n按回车键关闭...")
\ No newline at end of file
+        if logger:
+            logger.info("程序结束。\n---------------------------------------\n") # 文件日志
+            stop_logger(logger) # 写出后台队列中剩余的日志
+
+if __name__ == "__main__":
+    main()
+    # 作为脚本运行时等待用户按回车再关闭窗口；在同一进程中调用 main() 时不会阻塞在这里
+    input("\n按回车键关闭...")
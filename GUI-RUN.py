@@ -2,6 +2,7 @@ import tkinter as tk
 from tkinter import ttk, messagebox, filedialog
 from configparser import ConfigParser
 import os
+from config_utils import load_config_cached, save_config_cached, save_sections_cached, clear_path_cache
 
 # 配置文件名
 INI_FILE = 'configuration.ini'
@@ -17,10 +18,11 @@ DEFAULT_CONFIG = {
         'detailed_log_path': 'detailed_run.log'
     },
     'PARAMS': {
-        'retry_failed_points': 'False', # Moved to top for default order
+        'retry_failed_points': 'False', # Key order here is also the display order in the form
         'batch_size': '150',
         'num_batches': '10',
-        'max_point_workers': '5'
+        'max_point_workers': '5',
+        'encode_workers': '0'
     },
     'TILES': { # Default matches "Zoom 1(快速测试 , 2x1 瓦片)"
         'zoom': '1',
@@ -31,6 +33,9 @@ DEFAULT_CONFIG = {
     }
 }
 
+# 表单中各部分的键显示顺序 (小写)，即 DEFAULT_CONFIG 中的插入顺序；配置文件中的其他键排在其后
+DEFAULT_KEY_ORDER = {section.lower(): [key.lower() for key in items] for section, items in DEFAULT_CONFIG.items()}
+
 # 各配置部分的中文标题 (英文名将自动从section key获取)
 SECTION_NAME_MAP = {
     'PATHS': '路径配置',
@@ -50,6 +55,7 @@ LABEL_MAP = {
     'num_batches': '总批次数',
     'retry_failed_points': '重试已失败点位',
     'max_point_workers': '点位处理并发数',
+    'encode_workers': '图像编码进程数',
     'zoom': '缩放等级', # Zoom, Tile Size etc. will have key appended
     'tile_size': '图块尺寸',
     'tile_cols': '横向图块数',
@@ -67,6 +73,12 @@ PATH_KEYS = {
     'detailed_log_path': ('file', [('日志文件', '*.log'), ('所有文件', '*.*')]),
 }
 
+# 新建日志文件时写入的表头 (与 DOWNLOAD-Multithreads.py 中的日志列一致)；其他文件新建为空文件
+LOG_FILE_HEADERS = {
+    'log_path': 'ID\n',
+    'fail_log_path': 'ID,Reason,error_type\n',
+}
+
 # 图块参数预设定义 (使用您提供的新列表)
 TILE_PRESET_CUSTOM_NAME = "自定义 (Custom)"
 TILE_PRESETS = {
@@ -79,6 +91,9 @@ TILE_PRESETS = {
 }
 # 这些是受预设控制的图块参数键名 (小写)
 PRESET_CONTROLLED_TILE_KEYS = ['zoom', 'tile_size', 'tile_cols', 'tile_rows']
+# 反向索引：(zoom, tile_size, tile_cols, tile_rows) 取值元组 -> 预设名，启动时一次字典查找即可识别当前预设
+PRESET_BY_TUPLE = {tuple(preset_values.get(key_l) for key_l in PRESET_CONTROLLED_TILE_KEYS): preset_name
+                   for preset_name, preset_values in TILE_PRESETS.items()}
 
 
 if not os.path.exists(INI_FILE):
@@ -93,76 +108,106 @@ if not os.path.exists(INI_FILE):
         if not config.has_section(section_name):
              config[section_name] = items
 
-    with open(INI_FILE, 'w', encoding='utf-8') as f:
-        config.write(f)
+    save_config_cached(config, INI_FILE)
     print(f"提示：配置文件 {INI_FILE} 未找到，已根据默认设置创建。")
 
+def create_file_if_missing(path, header=''):
+    # One os.open(O_CREAT | O_EXCL) both checks and creates, so there is no separate exists probe and no race
+    # with a file appearing in between; the parent directory is only created if the open reports it missing.
+    # Returns True if the file was created.
+    flags = os.O_CREAT | os.O_EXCL | os.O_WRONLY
+    try:
+        fd = os.open(path, flags, 0o644)
+    except FileExistsError:
+        return False
+    except FileNotFoundError:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd = os.open(path, flags, 0o644)
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        f.write(header)
+    return True
+
 class ConfigEditor:
     def __init__(self, root_window):
         self.root = root_window
         self.root.title("谷歌街景下载器配置编辑器 (Google Street View Downloader Config Editor)")
         
-        self.style = ttk.Style()
-        self.style.theme_use('clam') 
-        self.default_font = ("微软雅黑", 10)
-        self.section_font = ("微软雅黑", 12, "bold")
-        self.root.option_add("*Font", self.default_font)
+        self.init_styles()
 
-        self.config = ConfigParser()
         # ConfigParser by default converts keys to lowercase. To preserve case from file:
-        self.config.optionxform = str 
-        self.config.read(INI_FILE, encoding='utf-8')
+        # (parsed result is cached next to the INI and reused while the file is unchanged)
+        self.config = load_config_cached(INI_FILE, preserve_case=True)
         self.ensure_config_completeness()
 
         self.entries = {}
+        self.entry_vars = {} # (section, key) -> tk.StringVar bound to the field's Entry; saving reads these directly
         self.boolean_vars = {}
         self.tile_preset_var = tk.StringVar() 
         self.tile_param_entries = {} 
+        self.tile_param_vars = {} # lowercase tile key -> StringVar of its Entry
+        self.preset_apply_after_id = None # Pending after_idle callback of on_tile_preset_change, if any
 
         self.check_and_initialize_logs()
         self.build_form()
         self.load_initial_tile_preset_state() 
 
-        self.root.update_idletasks()
+        # No forced update_idletasks() here: mainloop performs the first (and only) layout pass
         self.root.resizable(True, True)
 
+    def init_styles(self):
+        # All theme, font and named-style setup happens here, before the first widget exists,
+        # so no already-built widget has to be restyled and re-laid out
+        self.style = ttk.Style()
+        self.style.theme_use('clam') 
+        self.default_font = ("微软雅黑", 10)
+        self.section_font = ("微软雅黑", 12, "bold")
+        self.root.option_add("*Font", self.default_font)
+        # Configure named styles once; widgets then refer to them by name instead of passing font= each time
+        self.style.configure("Section.TLabel", font=self.section_font)
+        try:
+            self.style.configure("Accent.TButton", font=(self.default_font[0], self.default_font[1], "bold"))
+        except tk.TclError:
+            print("提示：当前主题可能不支持 Accent.TButton 样式。")
+
+    def build_case_index(self):
+        """Index the config's original-case section and key names by their lowercase form (one pass over the config)"""
+        self.section_case = {s_key.lower(): s_key for s_key in self.config.sections()} # section_lower -> section as written
+        self.key_case = { # (section_lower, key_lower) -> key as written
+            (s_key.lower(), item_k.lower()): item_k
+            for s_key in self.config.sections()
+            for item_k in self.config.options(s_key)
+        }
+
     def ensure_config_completeness(self):
-        dirty = False
+        self.build_case_index()
+        # One pass over the defaults collects only what is missing; a complete file (the usual case) returns without writing
+        missing_defaults = [
+            (section_key_default, key_default, default_value)
+            for section_key_default, default_items in DEFAULT_CONFIG.items()
+            for key_default, default_value in default_items.items()
+            if (section_key_default.lower(), key_default.lower()) not in self.key_case
+        ]
+        if not missing_defaults:
+            return
+
         # Preserve original case for sections and keys if they exist
         # If not, use DEFAULT_CONFIG's case
-        for section_key_default, default_items in DEFAULT_CONFIG.items():
+        for section_key_default, key_default, default_value in missing_defaults:
+            section_lower = section_key_default.lower()
             # Find if section exists, possibly with different case
-            actual_section_key = None
-            for s_key in self.config.sections():
-                if s_key.lower() == section_key_default.lower():
-                    actual_section_key = s_key
-                    break
-            
+            actual_section_key = self.section_case.get(section_lower)
             if not actual_section_key:
                 self.config.add_section(section_key_default) # Add with default case
-                actual_section_key = section_key_default
-                dirty = True
-
-            for key_default, default_value in default_items.items():
-                actual_item_key = None
-                if self.config.has_section(actual_section_key):
-                    for item_k in self.config.options(actual_section_key):
-                        if item_k.lower() == key_default.lower():
-                            actual_item_key = item_k
-                            break
-                
-                if not actual_item_key:
-                    self.config.set(actual_section_key, key_default, default_value) # Add with default case
-                    dirty = True
-        if dirty:
-            try:
-                with open(INI_FILE, 'w', encoding='utf-8') as configfile:
-                    self.config.write(configfile)
-                print(f"提示：配置文件 {INI_FILE} 已更新，补充了缺失的默认项。")
-                # Re-read to ensure consistency if we modified it
-                self.config.read(INI_FILE, encoding='utf-8')
-            except Exception as e:
-                print(f"⚠️ 无法写入更新后的配置文件 {INI_FILE}: {e}")
+                actual_section_key = self.section_case[section_lower] = section_key_default
+            self.config.set(actual_section_key, key_default, default_value) # Add with default case
+            self.key_case[(section_lower, key_default.lower())] = key_default
+
+        # Write once; the in-memory config and case index are already up to date, so nothing is re-read
+        try:
+            save_config_cached(self.config, INI_FILE)
+            print(f"提示：配置文件 {INI_FILE} 已更新，补充了缺失的默认项。")
+        except Exception as e:
+            print(f"⚠️ 无法写入更新后的配置文件 {INI_FILE}: {e}")
 
 
     def check_and_initialize_logs(self):
@@ -171,20 +216,21 @@ class ConfigEditor:
             if section_key_actual.lower() == 'paths': # Target 'PATHS' section, case-insensitively
                 for key_actual, path in self.config.items(section_key_actual):
                     if key_actual.lower() in ('log_path', 'fail_log_path', 'detailed_log_path'):
-                        if not os.path.exists(path):
-                            try:
-                                parent_dir = os.path.dirname(path)
-                                if parent_dir and not os.path.exists(parent_dir):
-                                    os.makedirs(parent_dir, exist_ok=True)
-                                with open(path, 'w', encoding='utf-8') as f:
-                                    if key_actual.lower() == 'fail_log_path': f.write('ID,Reason\n')
-                                    elif key_actual.lower() == 'log_path': f.write('ID\n')
+                        try:
+                            if create_file_if_missing(path, LOG_FILE_HEADERS.get(key_actual.lower(), '')):
+                                clear_path_cache() # 新建了文件，目录列表缓存失效
                                 print(f"提示：日志文件 {path} 未找到，已创建。")
-                            except Exception as e:
-                                print(f"⚠️ 无法创建日志文件 {path}：{e}")
+                        except Exception as e:
+                            print(f"⚠️ 无法创建日志文件 {path}：{e}")
 
     def on_tile_preset_change(self, event=None):
-        selected_preset_name = self.tile_preset_var.get()
+        # Coalesce bursts of changes (combobox selection, focus-in switching to custom) into one pass once Tk is idle
+        if self.preset_apply_after_id is None:
+            self.preset_apply_after_id = self.root.after_idle(self.apply_tile_preset)
+
+    def apply_tile_preset(self):
+        self.preset_apply_after_id = None
+        selected_preset_name = self.tile_preset_var.get() # Read when applied, so only the latest selection is processed
         
         if selected_preset_name == TILE_PRESET_CUSTOM_NAME:
             for key_lower in PRESET_CONTROLLED_TILE_KEYS:
@@ -193,15 +239,9 @@ class ConfigEditor:
         elif selected_preset_name in TILE_PRESETS:
             preset_values = TILE_PRESETS[selected_preset_name]
             for key_lower, entry_widget in self.tile_param_entries.items(): # key_lower is already lowercase
-                if key_lower in preset_values: # preset_values keys are also lowercase
-                    entry_widget.config(state='normal') 
-                    entry_widget.delete(0, tk.END)
-                    entry_widget.insert(0, preset_values[key_lower])
-                    entry_widget.config(state='readonly')
-                elif key_lower in PRESET_CONTROLLED_TILE_KEYS: 
-                    entry_widget.config(state='normal')
-                    entry_widget.delete(0, tk.END)
-                    entry_widget.config(state='readonly')
+                # Readonly entries still display their textvariable, so no state toggling is needed to update them
+                self.tile_param_vars[key_lower].set(preset_values.get(key_lower, '')) # preset_values keys are also lowercase
+                entry_widget.config(state='readonly')
 
     def handle_tile_entry_focus(self, event):
         if self.tile_preset_var.get() != TILE_PRESET_CUSTOM_NAME:
@@ -213,49 +253,24 @@ class ConfigEditor:
 
 
     def load_initial_tile_preset_state(self):
-        current_tile_config = {}
-        # Find the 'TILES' section, case-insensitively
-        tiles_section_actual_key = None
-        for s_key in self.config.sections():
-            if s_key.lower() == 'tiles':
-                tiles_section_actual_key = s_key
-                break
-
+        # Find the 'TILES' section and its options case-insensitively via the case index
+        tiles_section_actual_key = self.section_case.get('tiles')
+        current_tile_values = ()
         if tiles_section_actual_key:
-            for key_lower_controlled in PRESET_CONTROLLED_TILE_KEYS:
-                # Find the option, case-insensitively
-                actual_option_key = None
-                for opt_key in self.config.options(tiles_section_actual_key):
-                    if opt_key.lower() == key_lower_controlled:
-                        actual_option_key = opt_key
-                        break
-                if actual_option_key:
-                    current_tile_config[key_lower_controlled] = self.config.get(tiles_section_actual_key, actual_option_key)
-        
-        matched_preset = None
-        if current_tile_config: 
-            for preset_name, preset_values in TILE_PRESETS.items():
-                is_match = True
-                # preset_values keys are lowercase, current_tile_config keys are also lowercase here
-                if not all(current_tile_config.get(key_l) == value for key_l, value in preset_values.items()):
-                    is_match = False
-                # Ensure current_tile_config doesn't have extra controlled keys not in this preset
-                if is_match and not all(key_l in preset_values for key_l in current_tile_config if key_l in PRESET_CONTROLLED_TILE_KEYS):
-                     is_match = False
-                if is_match and len(current_tile_config) == len(preset_values): # Ensure same number of keys
-                    matched_preset = preset_name
-                    break
-        
-        if matched_preset:
-            self.tile_preset_var.set(matched_preset)
-        else:
-            self.tile_preset_var.set(TILE_PRESET_CUSTOM_NAME)
+            # Missing keys become None, which never matches a preset tuple
+            current_tile_values = tuple(
+                self.config.get(tiles_section_actual_key, self.key_case[('tiles', key_l)])
+                if ('tiles', key_l) in self.key_case else None
+                for key_l in PRESET_CONTROLLED_TILE_KEYS
+            )
+        self.tile_preset_var.set(PRESET_BY_TUPLE.get(current_tile_values, TILE_PRESET_CUSTOM_NAME))
         
         self.on_tile_preset_change() 
 
     def build_form(self):
+        # The frame is populated first and only gridded into the window at the end,
+        # so the window lays out the finished form once instead of after every added row
         main_frame = ttk.Frame(self.root, padding="10 10 10 10")
-        main_frame.grid(row=0, column=0, sticky=(tk.W, tk.E, tk.N, tk.S))
         self.root.columnconfigure(0, weight=1)
         self.root.rowconfigure(0, weight=1)
 
@@ -283,25 +298,16 @@ class ConfigEditor:
                  ttk.Separator(main_frame, orient='horizontal').grid(row=row_idx, column=0, columnspan=3, sticky='ew', pady=(15, 5))
                  row_idx += 1
             
-            section_label_widget = ttk.Label(main_frame, text=section_display_name, font=self.section_font)
+            section_label_widget = ttk.Label(main_frame, text=section_display_name, style="Section.TLabel")
             section_label_widget.grid(row=row_idx, column=0, columnspan=3, sticky='w', padx=5, pady=(0,5))
             row_idx += 1
 
-            # Define item order for PARAMS section
-            items_to_process_in_section = []
-            if section_key_upper_ordered == 'PARAMS':
-                param_order_lower = ['retry_failed_points', 'batch_size', 'num_batches', 'max_point_workers']
-                actual_options_map = {o.lower(): o for o in self.config.options(section_orig_case)}
-                for key_l_ordered in param_order_lower:
-                    if key_l_ordered in actual_options_map:
-                        orig_opt_key = actual_options_map[key_l_ordered]
-                        items_to_process_in_section.append((orig_opt_key, self.config.get(section_orig_case, orig_opt_key)))
-                # Add any other params not in defined order (for robustness if INI has more)
-                for opt_l, orig_opt_key in actual_options_map.items():
-                    if opt_l not in param_order_lower:
-                        items_to_process_in_section.append((orig_opt_key, self.config.get(section_orig_case, orig_opt_key)))
-            else: # For PATHS and TILES (or other sections)
-                items_to_process_in_section = list(self.config.items(section_orig_case))
+            # Known keys in DEFAULT_KEY_ORDER, looked up through the case index; any other keys in the INI follow in file order
+            section_lower = section_key_upper_ordered.lower()
+            default_keys_lower = DEFAULT_KEY_ORDER.get(section_lower, [])
+            ordered_keys = [self.key_case[(section_lower, key_l)] for key_l in default_keys_lower if (section_lower, key_l) in self.key_case]
+            ordered_keys += [opt_key for opt_key in self.config.options(section_orig_case) if opt_key.lower() not in default_keys_lower]
+            items_to_process_in_section = [(opt_key, self.config.get(section_orig_case, opt_key)) for opt_key in ordered_keys]
 
 
             if section_key_upper_ordered == 'TILES':
@@ -328,21 +334,22 @@ class ConfigEditor:
                     label_widget = ttk.Label(main_frame, text=widget_display_text)
                     label_widget.grid(row=row_idx, column=0, sticky='e', padx=(5,2), pady=2)
                     
-                    # Entry widgets
-                    entry = ttk.Entry(main_frame, width=45)
-                    entry.insert(0, value)
+                    # Entry widgets, each bound to a StringVar created with its initial value
+                    entry_var = tk.StringVar(value=value)
+                    entry = ttk.Entry(main_frame, width=45, textvariable=entry_var)
                     entry.grid(row=row_idx, column=1, padx=(0,10), pady=2, sticky='ew')
                     self.entries[(section_orig_case, key_original_case)] = entry
+                    self.entry_vars[(section_orig_case, key_original_case)] = entry_var
 
                     if section_key_upper_ordered == 'TILES' and key_l in PRESET_CONTROLLED_TILE_KEYS:
                         self.tile_param_entries[key_l] = entry 
+                        self.tile_param_vars[key_l] = entry_var
                         entry.bind("<FocusIn>", self.handle_tile_entry_focus)
                     
                     if key_l in PATH_KEYS:
                         btn = ttk.Button(main_frame, text="选择", command=lambda k_tuple=(section_orig_case, key_original_case): self.select_path(k_tuple))
                         btn.grid(row=row_idx, column=2, padx=5, pady=2)
                 
-                main_frame.columnconfigure(1, weight=1)
                 row_idx += 1
         
         # Process any sections not in section_order_display (if any, for robustness)
@@ -352,13 +359,12 @@ class ConfigEditor:
                 # This part can be omitted if section_order_display is exhaustive for display
                 pass
 
+        main_frame.columnconfigure(1, weight=1) # Entry column stretches with the window (set once, not per row)
+
         save_btn = ttk.Button(main_frame, text="保存配置 (Save Config)", command=self.save_config, style="Accent.TButton")
         save_btn.grid(row=row_idx, column=0, columnspan=3, pady=20)
-        
-        try:
-            self.style.configure("Accent.TButton", font=(self.default_font[0], self.default_font[1], "bold"))
-        except tk.TclError:
-            print("提示：当前主题可能不支持 Accent.TButton 样式。")
+
+        main_frame.grid(row=0, column=0, sticky=(tk.W, tk.E, tk.N, tk.S))
 
 
     def select_path(self, key_tuple):
@@ -366,44 +372,42 @@ class ConfigEditor:
         key_lower = key.lower()
         path_type, filetypes = PATH_KEYS.get(key_lower, ('file', None))
         
-        entry_widget = self.entries.get((section, key))
-        if not entry_widget: return
+        entry_var = self.entry_vars.get((section, key))
+        if not entry_var: return
 
-        current_path = entry_widget.get()
-        initial_dir = os.path.dirname(current_path) if current_path and os.path.exists(os.path.dirname(current_path)) else '.'
+        current_path = entry_var.get()
+        # No existence probe before opening the dialog; a missing directory is handled by the retry below
+        initial_dir = os.path.dirname(current_path) or '.'
         
         cn_label_text = LABEL_MAP.get(key_lower, key_lower.replace('_', ' ').title())
         dialog_title = f"选择 {cn_label_text} ({key})"
 
 
-        path = ""
-        if path_type == 'dir':
-            path = filedialog.askdirectory(initialdir=initial_dir, title=dialog_title)
-        else:
-            path = filedialog.askopenfilename(initialdir=initial_dir, filetypes=filetypes, title=dialog_title)
+        def ask_path(start_dir):
+            if path_type == 'dir':
+                return filedialog.askdirectory(initialdir=start_dir, title=dialog_title)
+            return filedialog.askopenfilename(initialdir=start_dir, filetypes=filetypes, title=dialog_title)
+
+        try:
+            path = ask_path(initial_dir)
+        except tk.TclError: # Initial directory rejected by the dialog, e.g. it does not exist
+            path = ask_path('.')
 
         if path:
-            entry_widget.delete(0, tk.END)
-            entry_widget.insert(0, path)
+            entry_var.set(path)
 
     def save_config(self):
-        temp_config = ConfigParser()
-        temp_config.optionxform = str # Preserve case when writing
+        new_sections = {} # section -> {key: value}, original case and file order; written directly without a second ConfigParser
 
         for section_orig_case_read in self.config.sections(): # Iterate based on current config's sections
-            temp_config.add_section(section_orig_case_read)
+            new_section_values = new_sections[section_orig_case_read] = {}
             for key_orig_case_read in self.config.options(section_orig_case_read):
                 key_l = key_orig_case_read.lower()
                 value_str = ""
 
                 if key_l == 'retry_failed_points':
-                    # Find the actual (section, key) tuple used for boolean_vars, which should match original case
-                    actual_tuple = None
-                    for s_k_tuple in self.boolean_vars:
-                        if s_k_tuple[0].lower() == section_orig_case_read.lower() and s_k_tuple[1].lower() == key_l:
-                            actual_tuple = s_k_tuple
-                            break
-                    bool_var = self.boolean_vars.get(actual_tuple)
+                    # boolean_vars is keyed by the same original-case (section, key) names iterated here
+                    bool_var = self.boolean_vars.get((section_orig_case_read, key_orig_case_read))
                     value_str = str(bool_var.get()) if bool_var else self.config.get(section_orig_case_read, key_orig_case_read) # fallback
                 
                 elif section_orig_case_read.lower() == 'tiles' and key_l in PRESET_CONTROLLED_TILE_KEYS:
@@ -411,29 +415,28 @@ class ConfigEditor:
                     if selected_preset_name != TILE_PRESET_CUSTOM_NAME and selected_preset_name in TILE_PRESETS:
                         value_str = TILE_PRESETS[selected_preset_name].get(key_l, self.config.get(section_orig_case_read, key_orig_case_read)) 
                     else: 
-                        entry = self.tile_param_entries.get(key_l) # tile_param_entries uses lowercase keys
-                        value_str = entry.get() if entry else self.config.get(section_orig_case_read, key_orig_case_read)
+                        entry_var = self.entry_vars.get((section_orig_case_read, key_orig_case_read))
+                        value_str = entry_var.get() if entry_var else self.config.get(section_orig_case_read, key_orig_case_read)
                 else: 
-                    entry = self.entries.get((section_orig_case_read, key_orig_case_read))
-                    value_str = entry.get() if entry else self.config.get(section_orig_case_read, key_orig_case_read)
+                    entry_var = self.entry_vars.get((section_orig_case_read, key_orig_case_read))
+                    value_str = entry_var.get() if entry_var else self.config.get(section_orig_case_read, key_orig_case_read)
 
                 # Path creation and validation logic (remains largely the same)
                 if key_l in PATH_KEYS:
                     try:
                         if PATH_KEYS[key_l][0] == 'dir':
-                            if value_str and not os.path.exists(value_str): os.makedirs(value_str, exist_ok=True)
+                            if value_str:
+                                # makedirs with exist_ok is idempotent; no need to probe the (possibly stale) path cache first
+                                os.makedirs(value_str, exist_ok=True)
+                                clear_path_cache()
                         else:
-                            parent_dir = os.path.dirname(value_str)
-                            if parent_dir and not os.path.exists(parent_dir): os.makedirs(parent_dir, exist_ok=True)
-                            if value_str and not os.path.exists(value_str):
-                                with open(value_str, 'w', encoding='utf-8') as f:
-                                    if key_l == 'fail_log_path': f.write('ID,Reason\n')
-                                    elif key_l == 'log_path': f.write('ID\n')
+                            if value_str and create_file_if_missing(value_str, LOG_FILE_HEADERS.get(key_l, '')):
+                                clear_path_cache()
                     except Exception as e:
                         messagebox.showerror("路径创建失败", f"为 [{section_orig_case_read}] {key_orig_case_read} ({value_str}) 创建路径时出错: {e}")
                         return
                 
-                if key_l in {'batch_size', 'num_batches', 'zoom', 'tile_size', 'tile_cols', 'tile_rows', 'max_point_workers'}:
+                if key_l in {'batch_size', 'num_batches', 'zoom', 'tile_size', 'tile_cols', 'tile_rows', 'max_point_workers', 'encode_workers'}:
                     if not value_str.isdigit() or int(value_str) < 0:
                         cn_text = LABEL_MAP.get(key_l, key_l)
                         messagebox.showerror("输入格式错误", f"[{section_orig_case_read}] {cn_text} ({key_orig_case_read}) 必须是一个非负整数。")
@@ -450,18 +453,24 @@ class ConfigEditor:
                         messagebox.showerror("输入格式错误", f"[{section_orig_case_read}] {cn_text} ({key_orig_case_read}) 必须是浮点数。")
                         return
                 
-                temp_config.set(section_orig_case_read, key_orig_case_read, value_str)
+                new_section_values[key_orig_case_read] = value_str
         
+        previous_values = []
         try:
-            with open(INI_FILE, 'w', encoding='utf-8') as configfile:
-                temp_config.write(configfile)
-            # Update self.config with the new, potentially case-preserved config
-            self.config = ConfigParser()
-            self.config.optionxform = str 
-            self.config.read(INI_FILE, encoding='utf-8')
+            # Update the in-memory config first instead of re-reading the file; sections and keys are unchanged, so the case index stays valid.
+            # ConfigParser.set rejects values it could not read back (e.g. a lone '%'), which stops the save before the file is touched
+            for section_orig_case_read, section_values in new_sections.items():
+                for key_orig_case_read, value_str in section_values.items():
+                    previous_values.append((section_orig_case_read, key_orig_case_read, self.config.get(section_orig_case_read, key_orig_case_read, raw=True)))
+                    self.config.set(section_orig_case_read, key_orig_case_read, value_str)
+            # Write the INI and refresh the parse cache in one step, so the downloader starts from the cache
+            save_sections_cached(new_sections, INI_FILE)
             messagebox.showinfo("保存成功", f"配置文件已保存到 {INI_FILE}")
         except Exception as e:
-            messagebox.showerror("保存失败", f"无法写入配置文件 {INI_FILE}: {e}")
+            # Nothing was written: roll the in-memory config back so it still matches the file on disk
+            for section_orig_case_read, key_orig_case_read, old_value in reversed(previous_values):
+                self.config.set(section_orig_case_read, key_orig_case_read, old_value)
+            messagebox.showerror("保存失败", f"配置文件 {INI_FILE} 未保存: {e}")
 
 if __name__ == '__main__':
     try:
@@ -0,0 +1,189 @@
+"""
+配置文件读取工具
+为配置编辑器 (GUI-RUN.py) 和下载脚本 (DOWNLOAD-Multithreads.py) 提供带缓存的 configuration.ini 读取，
+以及配置中各路径的批量存在性检查。
+"""
+
+import os
+import json
+import tempfile
+from configparser import ConfigParser
+from functools import lru_cache
+
+
+def _cache_path(ini_path):
+    """返回 INI 文件对应的旁路缓存文件路径"""
+    return ini_path + '.cache.json'
+
+
+def _parse_ini_sections(ini_path):
+    """
+    逐行解析 INI 文件，不经过 ConfigParser 的正则匹配和插值处理。
+    支持 ConfigParser 写出的以及手工编辑时常见的语法：[section] 节头、key = value 或 key: value、
+    以 # 或 ; 开头的注释行、缩进的续行。
+
+    Returns:
+        dict: {section: {key: value}} 形式的配置内容，键名保留原始大小写。
+    Raises:
+        ValueError: 存在无法识别的行、键值行出现在第一个节头之前，或同一节中有重复的键。
+    """
+    sections = {}
+    current_items = None
+    last_key = None
+    with open(ini_path, 'r', encoding='utf-8-sig') as f:
+        for line_no, raw_line in enumerate(f, 1):
+            line = raw_line.strip()
+            if not line or line[0] in '#;':
+                continue
+            if raw_line[0] in ' \t' and last_key is not None:
+                current_items[last_key] += '\n' + line # 缩进行是上一个值的续行
+                continue
+            if line[0] == '[' and line[-1] == ']':
+                current_items = sections.setdefault(line[1:-1], {})
+                last_key = None
+                continue
+            # 与 ConfigParser 相同，以最先出现的 '=' 或 ':' 作为分隔符
+            separator_positions = [pos for pos in (line.find('='), line.find(':')) if pos > 0]
+            if current_items is None or not separator_positions:
+                raise ValueError(f"无法解析 {ini_path} 第 {line_no} 行: {raw_line.rstrip()}")
+            separator_pos = min(separator_positions)
+            last_key = line[:separator_pos].rstrip()
+            if last_key in current_items:
+                # 与 ConfigParser 的 strict 模式一致，同一节中重复的键视为错误，而不是静默覆盖前面的值
+                raise ValueError(f"无法解析 {ini_path} 第 {line_no} 行: 键 '{last_key}' 在节中重复出现")
+            current_items[last_key] = line[separator_pos + 1:].lstrip()
+    return sections
+
+
+def load_config_cached(ini_path, preserve_case=False):
+    """
+    读取 INI 配置文件，解析结果缓存在旁路 JSON 文件中。
+    缓存以 INI 文件的修改时间和大小为键：两者均未变化时直接加载缓存，跳过逐行解析；
+    否则重新解析并刷新缓存。
+
+    Args:
+        ini_path (str): INI 文件路径。
+        preserve_case (bool): 是否保留键名大小写 (ConfigParser 默认会转为小写)。
+    Returns:
+        ConfigParser: 填充好配置内容的解析器对象。
+    """
+    stat = os.stat(ini_path)
+    cache_file = _cache_path(ini_path)
+
+    sections = None
+    try:
+        with open(cache_file, 'r', encoding='utf-8') as f:
+            cached = json.load(f)
+        if cached.get('mtime_ns') == stat.st_mtime_ns and cached.get('size') == stat.st_size:
+            sections = cached['sections']
+    except (OSError, ValueError, KeyError, AttributeError):
+        sections = None # 缓存不存在或已损坏，回退到完整解析
+
+    if sections is None:
+        sections = _parse_ini_sections(ini_path)
+        try:
+            with open(cache_file, 'w', encoding='utf-8') as f:
+                json.dump({'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'sections': sections}, f, ensure_ascii=False)
+        except OSError:
+            pass # 缓存写入失败不影响正常读取
+
+    config = ConfigParser()
+    if preserve_case:
+        config.optionxform = str
+    config.read_dict(sections)
+    return config
+
+
+def _format_ini(sections):
+    """按节和键的插入顺序直接生成 INI 文本，格式与 ConfigParser.write 的输出相同"""
+    lines = []
+    for section, items in sections.items():
+        lines.append(f'[{section}]\n')
+        for key, value in items.items():
+            value = value.replace('\n', '\n\t') # 多行值的续行缩进，与 ConfigParser 一致
+            lines.append(f'{key} = {value}\n')
+        lines.append('\n')
+    return ''.join(lines)
+
+
+def _atomic_write_text(path, text):
+    """
+    先写入同目录下的临时文件并落盘，再用 os.replace 原子替换目标文件。
+    写入中途出错或进程崩溃时，原文件保持完整，不会留下截断的配置。
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.' + os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        # mkstemp 创建的文件权限为 0600，替换前沿用原文件的权限（新文件使用常规的 0644）
+        try:
+            os.chmod(tmp_path, os.stat(path).st_mode & 0o777)
+        except FileNotFoundError:
+            os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def save_sections_cached(sections, ini_path):
+    """
+    将 {section: {key: value}} 形式的配置写入 INI 文件（不经过 ConfigParser），并立即刷新旁路缓存。
+    下次 load_config_cached 读取（包括下载脚本启动时）会直接命中缓存，无需再解析 INI。
+
+    Args:
+        sections (dict): 要保存的配置内容，节和键按插入顺序写出。
+        ini_path (str): INI 文件路径。
+    """
+    _atomic_write_text(ini_path, _format_ini(sections))
+    stat = os.stat(ini_path)
+    try:
+        with open(_cache_path(ini_path), 'w', encoding='utf-8') as f:
+            json.dump({'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'sections': sections}, f, ensure_ascii=False)
+    except OSError:
+        pass # 缓存写入失败不影响配置保存，下次读取时会重新解析
+
+
+def save_config_cached(config, ini_path):
+    """
+    将 ConfigParser 中的配置写入 INI 文件，并刷新旁路缓存。
+
+    Args:
+        config (ConfigParser): 要保存的配置。
+        ini_path (str): INI 文件路径。
+    """
+    save_sections_cached({
+        section: {key: config.get(section, key, raw=True) for key in config.options(section)}
+        for section in config.sections()
+    }, ini_path)
+
+
+@lru_cache(maxsize=64)
+def _dir_listing(parent_dir):
+    """列出目录下的所有条目名（每个目录只用一次 os.scandir 读取，结果缓存）"""
+    try:
+        with os.scandir(parent_dir or '.') as entries:
+            return frozenset(entry.name for entry in entries)
+    except OSError:
+        return frozenset()
+
+
+def path_exists_cached(path):
+    """
+    检查路径是否存在。
+    同一目录下的多个路径共用一次目录读取，代替逐个路径的 os.path.exists 系统调用；
+    目录列表中找不到时再用 os.path.exists 确认一次（例如 Windows 下大小写不一致的路径），避免误判。
+    写入新文件或目录后需调用 clear_path_cache() 使缓存失效。
+    """
+    parent_dir, name = os.path.split(os.path.normpath(path))
+    return name in _dir_listing(parent_dir) or os.path.exists(path)
+
+
+def clear_path_cache():
+    """清空目录列表缓存"""
+    _dir_listing.cache_clear()
@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 """
 谷歌街景图片黑边检测和处理脚本
-专门针对底部黑边进行优化，支持多线程处理、进度保存和中断恢复功能
+专门针对底部黑边进行优化，支持多进程并行处理、进度保存和中断恢复功能
 """
 
 # ===============================
@@ -17,7 +17,7 @@ PROBLEMATIC_DIR = "problematic"        # 有问题图片移动目录
 # 处理参数
 BLACK_THRESHOLD = 15                   # 黑边检测阈值 (0-255)
 MAX_IMAGES = None                      # 最大处理图片数量 (None表示处理所有, 调试时可设为100)
-NUM_WORKERS = 15                       # 并行处理线程数 (建议为CPU核心数的1-2倍)
+NUM_WORKERS = None                     # 并行处理进程数 (None表示使用CPU核心数)
 
 # 日志设置  
 LOG_LEVEL = "INFO"                     # 日志级别: DEBUG, INFO, WARNING, ERROR
@@ -25,22 +25,381 @@ LOG_LEVEL = "INFO"                     # 日志级别: DEBUG, INFO, WARNING, ERR
 # 黑边检测优化设置
 BOTTOM_BLACK_EDGE_RATIO = 0.05         # 底部黑边检测阈值（占图片高度的比例，5%）
 TARGET_ASPECT_RATIO = 2.0              # 目标宽高比 (2:1)
+RESIZE_TO_ORIGINAL = True              # 裁剪后是否拉伸回原始分辨率 (False 则直接保存裁剪结果，省去整图放大)
+REDUCED_DETECTION = True               # JPEG 图片先以 1/4 分辨率解码预检黑边，明显正常的图片不再做全分辨率解码
+
+# 写盘设置
+WRITE_BATCH_SIZE = 16                  # 处理后图片攒够多少张后交给写入线程集中写盘
+JPEG_QUALITY = 95                      # 处理后 JPEG 图片的编码质量 (1-100，95 与 OpenCV 默认值相同；降低可加快编码、减小文件)
+DETECT_COLUMN_STRIDE = 16              # 黑边检测时每隔多少列取一列计算行均值 (1 表示使用全部列)
 
 # ===============================
 
 import os
+import errno
 import cv2
 import numpy as np
 from PIL import Image
 import shutil
 import json
 import logging
+import logging.handlers
+import multiprocessing
+import atexit
 from pathlib import Path
 from tqdm import tqdm
 from datetime import datetime
 import time
 import concurrent.futures
-from threading import Lock
+from collections import deque
+from itertools import repeat
+
+# 可选依赖：libjpeg-turbo (PyTurboJPEG)，用于 JPEG 图片的解码和处理结果的编码；
+# 未安装 turbojpeg 包或找不到 libjpeg-turbo 动态库时使用 OpenCV
+try:
+    from turbojpeg import TurboJPEG, TJPF_BGR, TJSAMP_420
+    _tj = TurboJPEG()
+except Exception:
+    _tj = None
+
+JPEG_EXTENSIONS = ('.jpg', '.jpeg')
+REDUCED_DECODE_SCALE = 4 # 预检时的缩小倍数，对应 cv2.IMREAD_REDUCED_COLOR_4 和 turbojpeg 的 scaling_factor (1, 4)
+
+# 行亮度按 BT.601 加权计算，使用与 cv2.cvtColor(COLOR_BGR2GRAY) 相同的 14 位定点系数 (B, G, R)。
+# 灰度均值是各通道均值的线性组合，因此直接对 BGR 各通道求行和再加权，不需要生成灰度图
+LUMA_WEIGHTS_BGR = np.array([1868, 9617, 4899], dtype=np.int64)
+LUMA_WEIGHTS_GRAY = np.array([1 << 14], dtype=np.int64)
+LUMA_SCALE = 1 << 14
+
+# 可选依赖：numba，把黑边检测的逐行求和编译为机器码，从底部向上扫描到第一个非黑行即停止，
+# 不再生成整列的行和临时数组；未安装时使用 NumPy 向量化计算
+try:
+    from numba import njit
+
+    @njit(cache=True)
+    def find_valid_bottom(rows, channel_weights, row_sum_limit):
+        """从底部向上找到第一个加权行和大于上限的行，返回其下一行的行号；所有行都是黑的时返回 0"""
+        h, w, channels = rows.shape
+        for i in range(h - 1, -1, -1):
+            row_sum = np.int64(0)
+            for c in range(channels):
+                channel_sum = np.int64(0) # uint8 累加前先提升为 int64，避免溢出
+                for j in range(w):
+                    channel_sum += rows[i, j, c]
+                row_sum += channel_sum * channel_weights[c]
+            if row_sum > row_sum_limit:
+                return i + 1
+        return 0
+except ImportError:
+    def find_valid_bottom(rows, channel_weights, row_sum_limit):
+        """返回最后一个加权行和大于上限的行的下一行行号；所有行都是黑的时返回 0"""
+        # 一次向量化计算所有行各通道的整数行和，再按通道加权（不产生灰度图和浮点临时数组）
+        row_sums = rows.sum(axis=1, dtype=np.int64) @ channel_weights
+        non_black_rows = np.flatnonzero(row_sums > row_sum_limit)
+        return int(non_black_rows[-1]) + 1 if non_black_rows.size else 0
+
+logger = logging.getLogger(__name__)
+
+def detect_bottom_black_border(image, black_threshold):
+    """
+    优化版：只检测底部黑边
+
+    Args:
+        image: numpy数组格式的图片
+        black_threshold: 黑边检测阈值 (0-255)
+
+    Returns:
+        bool: 是否检测到底部黑边
+        int: 有效内容的底部边界（从顶部开始计算）
+    """
+    h, w = image.shape[:2]
+    if image.ndim == 2:
+        image = image[:, :, np.newaxis]
+        channel_weights = LUMA_WEIGHTS_GRAY
+    else:
+        channel_weights = LUMA_WEIGHTS_BGR # 以 IMREAD_COLOR 解码得到 3 通道 BGR
+
+    # 黑边是整行的纯黑区域，隔列抽样即可判断；抽样是视图，不复制像素，内存读取量减少约 DETECT_COLUMN_STRIDE 倍
+    sampled = image[:, ::DETECT_COLUMN_STRIDE]
+    # 行亮度均值 > 阈值 等价于 加权行和 > 阈值 × 抽样列数 × 定点缩放系数
+    row_sum_limit = black_threshold * sampled.shape[1] * LUMA_SCALE
+
+    # 先只检查底部 band_rows 行：其中只要有一行不是黑的，黑边高度就不会超过 BOTTOM_BLACK_EDGE_RATIO，
+    # 正常图片到此即可判定，不再处理上方的行
+    band_rows = min(h, int(h * BOTTOM_BLACK_EDGE_RATIO) + 1)
+    band_top = h - band_rows
+    valid_bottom = band_top + find_valid_bottom(sampled[band_top:], channel_weights, row_sum_limit)
+    if valid_bottom == band_top:
+        # 底部区域全黑，继续向上查找有效内容的底部边界
+        valid_bottom = find_valid_bottom(sampled[:band_top], channel_weights, row_sum_limit) if band_top else 0
+        if valid_bottom == 0:
+            valid_bottom = h # 整张图都是黑的时保持原逻辑：不视为底部黑边
+
+    # 计算底部黑边的高度
+    bottom_black_height = h - valid_bottom
+
+    # 判断是否有显著的底部黑边
+    has_bottom_black_border = bottom_black_height > h * BOTTOM_BLACK_EDGE_RATIO
+
+    # 每张图片都会调用：先判断日志级别，未开启 DEBUG 时不格式化消息
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"底部黑边检测: 图片尺寸={w}x{h}, 底部黑边高度={bottom_black_height}, "
+                     f"占比={bottom_black_height/h:.2%}, 检测结果={'有黑边' if has_bottom_black_border else '正常'}")
+
+    return has_bottom_black_border, valid_bottom
+
+def crop_from_top_left(image, valid_bottom):
+    """
+    优化版：从左上角开始裁剪，按2:1比例去除底部黑边和右边重复部分
+
+    Args:
+        image: 原始图片
+        valid_bottom: 有效内容的底部边界
+
+    Returns:
+        numpy.array: 裁剪后的图片
+    """
+    h, w = image.shape[:2]
+
+    # 去除底部黑边后的有效区域
+    valid_image = image[:valid_bottom, :]  # 从顶部到有效底部
+    valid_h, valid_w = valid_image.shape[:2]
+
+    logger.debug(f"去除底部黑边后尺寸: {valid_w}x{valid_h}")
+
+    # 按2:1比例从左上角开始裁剪
+    # 计算在当前高度下，2:1比例的理想宽度
+    ideal_width = int(valid_h * TARGET_ASPECT_RATIO)
+
+    if ideal_width <= valid_w:
+        # 如果理想宽度小于等于当前宽度，直接从左上角裁剪
+        cropped_image = valid_image[:, :ideal_width]
+        logger.debug(f"从左上角裁剪宽度: {ideal_width}")
+    else:
+        # 如果理想宽度大于当前宽度，说明高度过大，需要裁剪高度
+        ideal_height = int(valid_w / TARGET_ASPECT_RATIO)
+        cropped_image = valid_image[:ideal_height, :]
+        logger.debug(f"从左上角裁剪高度: {ideal_height}")
+
+    final_h, final_w = cropped_image.shape[:2]
+    logger.debug(f"最终裁剪尺寸: {final_w}x{final_h}, 比例: {final_w/final_h:.2f}")
+    return cropped_image
+
+# 拉伸结果的输出缓冲区，每个工作进程一份：同一批街景图分辨率相同，不必为每张图片重新分配整幅图的内存
+_resize_buffer = None
+
+def resize_to_original(processed_image, original_shape):
+    """
+    将处理后的图片拉伸到原始分辨率
+    返回的数组是进程内复用的缓冲区，下一次调用会覆盖其内容，需要在此之前完成编码
+
+    Args:
+        processed_image: 处理后的图片
+        original_shape: 原始图片的形状 (height, width)
+
+    Returns:
+        numpy.array: 拉伸后的图片
+    """
+    global _resize_buffer
+    original_h, original_w = original_shape[:2]
+    target_shape = (original_h, original_w) + processed_image.shape[2:]
+    if (_resize_buffer is None or _resize_buffer.shape != target_shape
+            or _resize_buffer.dtype != processed_image.dtype):
+        _resize_buffer = np.empty(target_shape, dtype=processed_image.dtype)
+    resized_image = cv2.resize(processed_image, (original_w, original_h), dst=_resize_buffer,
+                               interpolation=cv2.INTER_CUBIC)
+    return resized_image
+
+def decode_image(encoded_image, extension):
+    """
+    解码内存中的图片字节为 BGR 数组；JPEG 优先使用 libjpeg-turbo，其他格式或 turbojpeg 解码失败时使用 OpenCV
+    
+    Args:
+        encoded_image: 图片文件内容 (uint8 数组)
+        extension: 文件扩展名（小写，含点号）
+        
+    Returns:
+        numpy.array: BGR 图片，无法解码时为 None
+    """
+    if _tj is not None and extension in JPEG_EXTENSIONS:
+        try:
+            return _tj.decode(encoded_image, pixel_format=TJPF_BGR)
+        except Exception:
+            pass # 损坏或实际不是 JPEG 的文件交给 OpenCV 判断
+    return cv2.imdecode(encoded_image, cv2.IMREAD_COLOR)
+
+def decode_reduced_image(encoded_image, extension):
+    """
+    以 1/REDUCED_DECODE_SCALE 分辨率解码 JPEG：libjpeg 在 IDCT 阶段直接输出缩小的图像，
+    计算量和像素内存约为全分辨率解码的 1/16。其他格式没有缩小解码的捷径，返回 None
+    
+    Args:
+        encoded_image: 图片文件内容 (uint8 数组)
+        extension: 文件扩展名（小写，含点号）
+        
+    Returns:
+        numpy.array: 缩小后的 BGR 图片，非 JPEG 或无法解码时为 None
+    """
+    if extension not in JPEG_EXTENSIONS:
+        return None
+    if _tj is not None:
+        try:
+            return _tj.decode(encoded_image, pixel_format=TJPF_BGR, scaling_factor=(1, REDUCED_DECODE_SCALE))
+        except Exception:
+            pass
+    return cv2.imdecode(encoded_image, cv2.IMREAD_REDUCED_COLOR_4)
+
+def is_clearly_normal(small_image, black_threshold):
+    """
+    在缩小解码的图片上预检底部黑边：黑边高度（按缩小倍数换算并多留一个缩小行的余量）
+    仍不超过 BOTTOM_BLACK_EDGE_RATIO 时判定为正常；接近阈值的图片交给全分辨率检测
+    
+    Args:
+        small_image: 缩小解码的 BGR 图片
+        black_threshold: 黑边检测阈值 (0-255)
+        
+    Returns:
+        bool: 是否可以不做全分辨率解码直接判定为正常图片
+    """
+    small_h = small_image.shape[0]
+    _, small_valid_bottom = detect_bottom_black_border(small_image, black_threshold)
+    max_black_height = (small_h - small_valid_bottom + 1) * REDUCED_DECODE_SCALE
+    min_original_h = (small_h - 1) * REDUCED_DECODE_SCALE + 1 # 缩小解码的高度向上取整
+    return max_black_height <= min_original_h * BOTTOM_BLACK_EDGE_RATIO
+
+def encode_image(image, extension):
+    """
+    按扩展名编码图片；JPEG 优先使用 libjpeg-turbo（4:2:0 色度抽样与 OpenCV 默认设置一致），两种编码器都使用 JPEG_QUALITY
+    
+    Args:
+        image: BGR 图片
+        extension: 文件扩展名（含点号），决定输出格式，与 cv2.imwrite 按扩展名选择格式的行为一致
+        
+    Returns:
+        编码后的图片数据 (bytes 或 uint8 数组)，编码失败时为 None
+    """
+    if _tj is not None and extension.lower() in JPEG_EXTENSIONS:
+        return _tj.encode(np.ascontiguousarray(image), quality=JPEG_QUALITY, pixel_format=TJPF_BGR, jpeg_subsample=TJSAMP_420)
+    params = []
+    if extension.lower() in JPEG_EXTENSIONS:
+        # 关闭霍夫曼表优化和渐进式编码 (OpenCV 默认也是关闭的，这里显式指定)，只做一遍基线编码
+        params = [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY, cv2.IMWRITE_JPEG_OPTIMIZE, 0, cv2.IMWRITE_JPEG_PROGRESSIVE, 0]
+    success, encoded = cv2.imencode(extension, image, params)
+    return encoded if success else None
+
+def init_worker(opencv_threads, log_queue, log_level):
+    """
+    工作进程初始化：为每个进程分配互不重叠的 OpenCV 内部线程数，
+    避免每个进程里的 cv2.resize 等并行算子都占满全部核心、彼此争抢；
+    日志只放入队列，由主进程的监听线程统一写入文件和控制台
+    
+    Args:
+        opencv_threads: 每个进程内 OpenCV 可使用的线程数
+        log_queue: 主进程创建的日志队列
+        log_level: 日志级别
+    """
+    cv2.setUseOptimized(True)
+    cv2.setNumThreads(opencv_threads)
+    
+    # spawn 启动的进程没有日志配置，fork 启动的进程继承了主进程的配置；两种情况都统一改为写入队列
+    root_logger = logging.getLogger()
+    root_logger.handlers[:] = [logging.handlers.QueueHandler(log_queue)]
+    root_logger.setLevel(log_level)
+
+def process_image_file(image_path_str, black_threshold):
+    """
+    处理单张图片（在工作进程中运行，只使用参数和模块级函数，不访问处理器对象）
+    工作进程不写盘：有黑边的图片编码后返回给主进程，由写入线程统一移动原图并写入结果
+    
+    Args:
+        image_path_str: 图片路径
+        black_threshold: 黑边检测阈值 (0-255)
+        
+    Returns:
+        tuple: (文件名, 处理结果状态 'normal'/'problematic'/'failed', 失败原因或 None, 编码后的处理结果图片或 None)
+    """
+    filename = os.path.basename(image_path_str)
+    extension = os.path.splitext(filename)[1]
+    try:
+        # 读取图片：一次读入文件字节再在内存中解码（cv2.imread 在 Windows 下无法打开含中文等非 ASCII 字符的路径）
+        encoded_image = np.fromfile(image_path_str, dtype=np.uint8)
+        if not encoded_image.size:
+            return filename, 'failed', f"无法读取图片: {image_path_str}", None
+        
+        # 大多数图片没有黑边：先用缩小解码预检，明显正常的图片不再做全分辨率解码
+        if REDUCED_DETECTION:
+            small_image = decode_reduced_image(encoded_image, extension.lower())
+            if small_image is not None and is_clearly_normal(small_image, black_threshold):
+                logger.debug(f"正常图片: {filename}")
+                return filename, 'normal', None, None
+        
+        # 可能有黑边（或无法缩小解码）时按全分辨率解码，重新检测精确的有效边界
+        image = decode_image(encoded_image, extension.lower())
+        if image is None:
+            return filename, 'failed', f"无法读取图片: {image_path_str}", None
+            
+        original_shape = image.shape
+        
+        # 检测底部黑边
+        has_bottom_black_border, valid_bottom = detect_bottom_black_border(image, black_threshold)
+        
+        if not has_bottom_black_border:
+            logger.debug(f"正常图片: {filename}")
+            return filename, 'normal', None, None
+        
+        # 处理图片：从左上角裁剪，按需拉伸回原始分辨率
+        cropped_image = crop_from_top_left(image, valid_bottom)
+        final_image = resize_to_original(cropped_image, original_shape) if RESIZE_TO_ORIGINAL else cropped_image
+        
+        # 按原文件扩展名编码
+        encoded = encode_image(final_image, extension)
+        if encoded is None:
+            return filename, 'failed', f"编码处理后图片失败: {filename}", None
+        
+        return filename, 'problematic', None, encoded
+        
+    except Exception as e:
+        return filename, 'failed', f"处理图片 {image_path_str} 时出错: {str(e)}", None
+
+def write_processed_images(batch, problematic_dir_str, output_dir_str):
+    """
+    在单独的写入线程中依次落盘一批有黑边的图片，避免多个进程同时写盘造成磁头来回寻道
+    
+    Args:
+        batch: [(文件名, 原图路径, 编码后的处理结果图片), ...]
+        problematic_dir_str: 有问题原图移动目录
+        output_dir_str: 处理后图片输出目录
+        
+    Returns:
+        list: [(文件名, 处理结果状态 'problematic'/'failed', 失败原因或 None), ...]
+    """
+    results = []
+    for filename, image_path_str, encoded in batch:
+        # 移动原图到problematic文件夹：同一文件系统内直接重命名，只有跨文件系统时才由 shutil.move 复制后删除
+        problematic_path = os.path.join(problematic_dir_str, filename)
+        try:
+            try:
+                os.replace(image_path_str, problematic_path)
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                shutil.move(image_path_str, problematic_path)
+        except Exception as e:
+            results.append((filename, 'failed', f"移动文件失败 {filename}: {e}"))
+            continue
+        
+        # 保存处理后的图片到edit文件夹
+        output_path = os.path.join(output_dir_str, filename)
+        try:
+            with open(output_path, 'wb') as f:
+                f.write(encoded)
+        except Exception as e:
+            results.append((filename, 'failed', f"保存处理后图片失败: {output_path}: {e}"))
+            continue
+        
+        logger.debug(f"处理有底部黑边图片: {filename}")
+        results.append((filename, 'problematic', None))
+    return results
 
 class OptimizedPanoramaProcessor:
     def __init__(self):
@@ -52,7 +411,7 @@ class OptimizedPanoramaProcessor:
         self.problematic_dir = Path(PROBLEMATIC_DIR)
         self.black_threshold = BLACK_THRESHOLD
         self.max_images = MAX_IMAGES
-        self.num_workers = NUM_WORKERS
+        self.num_workers = NUM_WORKERS or os.cpu_count() or 1
         
         # 创建输出目录
         self.output_dir.mkdir(exist_ok=True)
@@ -61,9 +420,10 @@ class OptimizedPanoramaProcessor:
         # 设置日志
         self.setup_logging()
         
-        # 进度文件路径
+        # 进度文件路径：完整快照只在结束或中断时写入，运行过程中每张图片的结果追加到进度日志
         self.progress_file = Path("processing_progress.json")
-        self.lock = Lock()
+        self.progress_log_file = Path("processing_progress.ndjson")
+        self.progress_log = None
         
         # 统计信息
         self.stats = {
@@ -89,21 +449,28 @@ class OptimizedPanoramaProcessor:
     def setup_logging(self):
         """设置日志配置"""
         log_filename = f"panorama_processing_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log"
-        
-        logging.basicConfig(
-            level=getattr(logging, LOG_LEVEL.upper()),
-            format='%(asctime)s - %(levelname)s - %(message)s',
-            handlers=[
-                logging.FileHandler(log_filename, encoding='utf-8'),
-                logging.StreamHandler()
-            ]
-        )
+        self.log_level = getattr(logging, LOG_LEVEL.upper())
+        
+        # 主进程和工作进程的日志记录都只放入队列，由监听线程写文件和控制台，处理图片的代码不等待磁盘 I/O
+        formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+        handlers = [logging.FileHandler(log_filename, encoding='utf-8'), logging.StreamHandler()]
+        for handler in handlers:
+            handler.setFormatter(formatter)
+        self.log_queue = multiprocessing.Queue()
+        self.log_listener = logging.handlers.QueueListener(self.log_queue, *handlers)
+        self.log_listener.start()
+        atexit.register(self.log_listener.stop) # 退出前写完队列中剩余的日志
+        
+        root_logger = logging.getLogger()
+        root_logger.setLevel(self.log_level)
+        root_logger.addHandler(logging.handlers.QueueHandler(self.log_queue))
         self.logger = logging.getLogger(__name__)
         self.logger.info(f"日志文件: {log_filename}")
-        self.logger.info(f"配置参数: 输入目录={INPUT_DIR}, 输出目录={OUTPUT_DIR}, 线程数={NUM_WORKERS}")
+        self.logger.info(f"配置参数: 输入目录={INPUT_DIR}, 输出目录={OUTPUT_DIR}, 进程数={self.num_workers}")
     
     def load_progress(self):
-        """加载处理进度"""
+        """加载处理进度：先读取上次保存的完整快照，再按顺序重放之后追加的进度日志"""
+        loaded = False
         if self.progress_file.exists():
             try:
                 with open(self.progress_file, 'r', encoding='utf-8') as f:
@@ -115,200 +482,73 @@ class OptimizedPanoramaProcessor:
                     self.progress_data['normal_files'] = set(data.get('normal_files', []))
                     self.progress_data['last_update'] = data.get('last_update')
                     self.progress_data['total_files'] = data.get('total_files', 0)
-                
-                processed_count = len(self.progress_data['processed_files'])
-                self.logger.info(f"从进度文件恢复: 已处理 {processed_count} 张图片")
-                return True
+                loaded = True
             except Exception as e:
                 self.logger.error(f"加载进度文件失败: {e}")
-                return False
-        return False
-    
-    def save_progress(self):
-        """保存处理进度"""
-        try:
-            with self.lock:
-                # 转换集合为列表以便JSON序列化
-                data = {
-                    'processed_files': list(self.progress_data['processed_files']),
-                    'problematic_files': list(self.progress_data['problematic_files']),
-                    'failed_files': list(self.progress_data['failed_files']),
-                    'normal_files': list(self.progress_data['normal_files']),
-                    'last_update': datetime.now().isoformat(),
-                    'total_files': self.progress_data['total_files'],
-                    'stats': self.stats
-                }
-                
-                with open(self.progress_file, 'w', encoding='utf-8') as f:
-                    json.dump(data, f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            self.logger.error(f"保存进度文件失败: {e}")
-    
-    def detect_bottom_black_border(self, image):
-        """
-        优化版：只检测底部黑边
-        
-        Args:
-            image: numpy数组格式的图片
-            
-        Returns:
-            bool: 是否检测到底部黑边
-            int: 有效内容的底部边界（从顶部开始计算）
-        """
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if len(image.shape) == 3 else image
-        h, w = gray.shape
         
-        # 从底部向上检测黑边
-        valid_bottom = h
-        
-        # 优化：从底部向上完整扫描，找到第一个非黑像素行即可确定边界
-        for i in range(h - 1, -1, -1):
-            if np.mean(gray[i, :]) > self.black_threshold:
-                valid_bottom = i + 1
-                break
-        
-        # 计算底部黑边的高度
-        bottom_black_height = h - valid_bottom
-        
-        # 判断是否有显著的底部黑边
-        has_bottom_black_border = bottom_black_height > h * BOTTOM_BLACK_EDGE_RATIO
-        
-        self.logger.debug(f"底部黑边检测: 图片尺寸={w}x{h}, 底部黑边高度={bottom_black_height}, "
-                         f"占比={bottom_black_height/h:.2%}, 检测结果={'有黑边' if has_bottom_black_border else '正常'}")
+        if self.progress_log_file.exists():
+            try:
+                with open(self.progress_log_file, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                            self.mark_progress(entry['f'], entry['s'])
+                        except (ValueError, KeyError, TypeError):
+                            continue # 进程被强制结束时最后一行可能只写了一半
+                        loaded = True
+            except Exception as e:
+                self.logger.error(f"读取进度日志失败: {e}")
         
-        return has_bottom_black_border, valid_bottom
+        if loaded:
+            processed_count = len(self.progress_data['processed_files'])
+            self.logger.info(f"从进度文件恢复: 已处理 {processed_count} 张图片")
+        return loaded
     
-    def crop_from_top_left(self, image, valid_bottom):
-        """
-        优化版：从左上角开始裁剪，按2:1比例去除底部黑边和右边重复部分
-        
-        Args:
-            image: 原始图片
-            valid_bottom: 有效内容的底部边界
-            
-        Returns:
-            numpy.array: 裁剪后的图片
-        """
-        h, w = image.shape[:2]
-        
-        # 去除底部黑边后的有效区域
-        valid_image = image[:valid_bottom, :]  # 从顶部到有效底部
-        valid_h, valid_w = valid_image.shape[:2]
-        
-        self.logger.debug(f"去除底部黑边后尺寸: {valid_w}x{valid_h}")
-        
-        # 按2:1比例从左上角开始裁剪
-        # 计算在当前高度下，2:1比例的理想宽度
-        ideal_width = int(valid_h * TARGET_ASPECT_RATIO)
-        
-        if ideal_width <= valid_w:
-            # 如果理想宽度小于等于当前宽度，直接从左上角裁剪
-            cropped_image = valid_image[:, :ideal_width]
-            self.logger.debug(f"从左上角裁剪宽度: {ideal_width}")
-        else:
-            # 如果理想宽度大于当前宽度，说明高度过大，需要裁剪高度
-            ideal_height = int(valid_w / TARGET_ASPECT_RATIO)
-            cropped_image = valid_image[:ideal_height, :]
-            self.logger.debug(f"从左上角裁剪高度: {ideal_height}")
-            
-        final_h, final_w = cropped_image.shape[:2]
-        self.logger.debug(f"最终裁剪尺寸: {final_w}x{final_h}, 比例: {final_w/final_h:.2f}")
-        return cropped_image
-    
-    def resize_to_original(self, processed_image, original_shape):
-        """
-        将处理后的图片拉伸到原始分辨率
-        
-        Args:
-            processed_image: 处理后的图片
-            original_shape: 原始图片的形状 (height, width)
-            
-        Returns:
-            numpy.array: 拉伸后的图片
-        """
-        original_h, original_w = original_shape[:2]
-        resized_image = cv2.resize(processed_image, (original_w, original_h), 
-                                 interpolation=cv2.INTER_CUBIC)
-        return resized_image
+    def mark_progress(self, filename, result):
+        """把一张图片的处理结果记入进度集合 (result: 'normal' / 'problematic' / 'failed')"""
+        if result == 'failed':
+            self.progress_data['failed_files'].add(filename)
+        elif result in ('normal', 'problematic'):
+            self.progress_data[f'{result}_files'].add(filename)
+            self.progress_data['processed_files'].add(filename)
     
-    def process_single_image(self, image_path):
-        """
-        处理单张图片
-        
-        Args:
-            image_path: 图片路径
-            
-        Returns:
-            str: 处理结果状态 ('normal', 'problematic', 'failed', 'skipped')
-        """
+    def save_progress(self):
+        """保存处理进度 (进度集合只在主线程中读写，不需要加锁)"""
         try:
-            filename = image_path.name
+            # 转换集合为列表以便JSON序列化
+            data = {
+                'processed_files': list(self.progress_data['processed_files']),
+                'problematic_files': list(self.progress_data['problematic_files']),
+                'failed_files': list(self.progress_data['failed_files']),
+                'normal_files': list(self.progress_data['normal_files']),
+                'last_update': datetime.now().isoformat(),
+                'total_files': self.progress_data['total_files'],
+                'stats': self.stats
+            }
             
-            # 检查是否已经处理过
-            if filename in self.progress_data['processed_files']:
-                return 'skipped'
-            
-            # 读取图片
-            image = cv2.imread(str(image_path))
-            if image is None:
-                self.logger.warning(f"无法读取图片: {image_path}")
-                with self.lock:
-                    self.progress_data['failed_files'].add(filename)
-                return 'failed'
-                
-            original_shape = image.shape
-            
-            # 检测底部黑边
-            has_bottom_black_border, valid_bottom = self.detect_bottom_black_border(image)
-            
-            if has_bottom_black_border:
-                # 移动原图到problematic文件夹
-                problematic_path = self.problematic_dir / filename
-                try:
-                    shutil.move(str(image_path), str(problematic_path))
-                except Exception as e:
-                    self.logger.error(f"移动文件失败 {filename}: {e}")
-                    return 'failed'
-                
-                # 处理图片：从左上角裁剪
-                cropped_image = self.crop_from_top_left(image, valid_bottom)
-                final_image = self.resize_to_original(cropped_image, original_shape)
-                
-                # 保存处理后的图片到edit文件夹
-                output_path = self.output_dir / filename
-                success = cv2.imwrite(str(output_path), final_image)
-                if not success:
-                    self.logger.error(f"保存处理后图片失败: {output_path}")
-                    return 'failed'
-                
-                with self.lock:
-                    self.progress_data['problematic_files'].add(filename)
-                    self.progress_data['processed_files'].add(filename)
-                
-                self.logger.debug(f"处理有底部黑边图片: {filename}")
-                return 'problematic'
-            else:
-                with self.lock:
-                    self.progress_data['normal_files'].add(filename)
-                    self.progress_data['processed_files'].add(filename)
-                
-                self.logger.debug(f"正常图片: {filename}")
-                return 'normal'
+            # 先写临时文件再替换，写入中途中断也不会损坏上一次的快照
+            tmp_file = self.progress_file.with_name(self.progress_file.name + '.tmp')
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_file, self.progress_file)
             
+            # 快照已包含进度日志中的全部记录，清空日志
+            with open(self.progress_log_file, 'w', encoding='utf-8'):
+                pass
         except Exception as e:
-            self.logger.error(f"处理图片 {image_path} 时出错: {str(e)}")
-            with self.lock:
-                self.progress_data['failed_files'].add(filename)
-            return 'failed'
+            self.logger.error(f"保存进度文件失败: {e}")
     
     def get_image_files(self):
-        """获取所有图片文件"""
-        image_extensions = ['.jpg', '.jpeg', '.png', '.bmp', '.tiff']
-        image_files = []
-        
-        for ext in image_extensions:
-            image_files.extend(list(self.input_dir.glob(f'*{ext}')))
-            image_files.extend(list(self.input_dir.glob(f'*{ext.upper()}')))
+        """获取所有图片文件，返回 [(文件名, 路径字符串), ...]，直接使用 DirEntry 已有的字符串，不构造 Path 对象"""
+        image_extensions = {'.jpg', '.jpeg', '.png', '.bmp', '.tiff'}
+        if not self.input_dir.is_dir():
+            return []
+
+        # 只遍历一次目录，在 Python 中按后缀匹配 (不区分大小写)，代替每个扩展名的大小写各 glob 一次；
+        # DirEntry.is_file() 使用遍历时已取得的文件类型，大多数系统上不需要额外的 stat
+        with os.scandir(self.input_dir) as entries:
+            image_files = [(entry.name, entry.path) for entry in entries
+                           if entry.is_file() and os.path.splitext(entry.name)[1].lower() in image_extensions]
         
         # 如果设置了最大处理数量，则限制文件数量
         if self.max_images:
@@ -324,7 +564,7 @@ class OptimizedPanoramaProcessor:
         print(f"📂 输入目录: {INPUT_DIR}")
         print(f"📁 输出目录: {OUTPUT_DIR}")
         print(f"⚠️  问题图片目录: {PROBLEMATIC_DIR}")
-        print(f"🧵 并行线程数: {NUM_WORKERS}")
+        print(f"🧵 并行进程数: {self.num_workers}")
         if MAX_IMAGES:
             print(f"🔢 限制处理数量: {MAX_IMAGES} 张")
         print(f"🎯 专门优化: 仅检测底部黑边，从左上角裁剪")
@@ -339,8 +579,8 @@ class OptimizedPanoramaProcessor:
         
         # 过滤已处理的文件
         unprocessed_files = [
-            f for f in image_files 
-            if f.name not in self.progress_data['processed_files']
+            (filename, image_path_str) for filename, image_path_str in image_files
+            if filename not in self.progress_data['processed_files']
         ]
         
         self.stats['total_images'] = total_files
@@ -372,15 +612,20 @@ class OptimizedPanoramaProcessor:
         problematic_count = len(self.progress_data['problematic_files'])
         failed_count = len(self.progress_data['failed_files'])
         
-        def update_progress(result):
+        def update_progress(filename, result, message):
             nonlocal normal_count, problematic_count, failed_count
             
+            # 进度集合只在主进程中更新，工作进程只返回结果
             if result == 'normal':
                 normal_count += 1
             elif result == 'problematic':
                 problematic_count += 1
             elif result == 'failed':
                 failed_count += 1
+                self.logger.error(message)
+            self.mark_progress(filename, result)
+            # 每张图片的结果追加一行到进度日志 (O(1))，代替定期把全部集合重新写成 JSON
+            self.progress_log.write(json.dumps({'f': filename, 's': result}, ensure_ascii=False) + '\n')
             
             # 更新进度条描述
             progress_bar.set_postfix({
@@ -389,35 +634,71 @@ class OptimizedPanoramaProcessor:
                 '❌失败': failed_count
             })
             progress_bar.update(1)
-            
-            # 定期保存进度
-            if (normal_count + problematic_count + failed_count) % 100 == 0:
-                self.save_progress()
         
+        # 单个写入线程按批次依次写盘，有黑边图片的进度在写盘完成后才记录
+        write_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="writer")
+        pending_writes = []
+        write_futures = deque()
+        
+        def flush_writes():
+            if pending_writes:
+                write_futures.append(write_executor.submit(
+                    write_processed_images, list(pending_writes), str(self.problematic_dir), str(self.output_dir)
+                ))
+                pending_writes.clear()
+        
+        def drain_writes(wait=False):
+            while write_futures and (wait or write_futures[0].done()):
+                for filename, result, message in write_futures.popleft().result():
+                    update_progress(filename, result, message)
+        
+        image_path_strs = [image_path_str for _, image_path_str in unprocessed_files]
+        # 行缓冲：每条记录立即写入文件，进程被强制结束时也只会丢失最后一行
+        self.progress_log = open(self.progress_log_file, 'a', encoding='utf-8', buffering=1)
         try:
-            # 多线程处理
-            with concurrent.futures.ThreadPoolExecutor(max_workers=self.num_workers) as executor:
-                # 提交所有任务
-                future_to_file = {
-                    executor.submit(self.process_single_image, image_path): image_path
-                    for image_path in unprocessed_files
-                }
+            # 多进程处理：检测和裁剪是 CPU 密集的 NumPy/OpenCV 计算，每个进程有独立的解释器，不再争抢 GIL
+            opencv_threads = max(1, (os.cpu_count() or 1) // self.num_workers)
+            # numba 可用时先在主进程中用一张很小的图编译黑边检测内核 (与实际调用的数组类型相同) 并写入磁盘缓存：
+            # fork 出的工作进程直接继承编译结果，spawn 的工作进程从缓存加载，不会在第一张图片上各自重复编译
+            detect_bottom_black_border(np.zeros((2, 2 * DETECT_COLUMN_STRIDE, 3), dtype=np.uint8), self.black_threshold)
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.num_workers, initializer=init_worker,
+                initargs=(opencv_threads, self.log_queue, self.log_level)
+            ) as executor:
+                # 按块分发任务，摊薄进程间通信开销
+                chunksize = max(1, len(unprocessed_files) // (4 * self.num_workers))
+                results = executor.map(
+                    process_image_file,
+                    image_path_strs,
+                    repeat(self.black_threshold),
+                    chunksize=chunksize
+                )
                 
-                # 处理完成的任务
-                for future in concurrent.futures.as_completed(future_to_file):
-                    try:
-                        result = future.result()
-                        update_progress(result)
-                    except Exception as e:
-                        self.logger.error(f"处理任务时出错: {e}")
-                        update_progress('failed')
+                # 处理完成的任务（process_image_file 内部已捕获异常，不会在这里抛出）
+                for image_path_str, (filename, result, message, encoded) in zip(image_path_strs, results):
+                    if result == 'problematic':
+                        pending_writes.append((filename, image_path_str, encoded))
+                        if len(pending_writes) >= WRITE_BATCH_SIZE:
+                            flush_writes()
+                    else:
+                        update_progress(filename, result, message)
+                    drain_writes()
+            
+            flush_writes()
+            drain_writes(wait=True)
         
         except KeyboardInterrupt:
             self.logger.info("收到中断信号，正在保存进度...")
+            # 先等待已提交的写盘批次完成并记入进度，再保存快照：这些图片的原图已被移走，漏记会导致下次运行找不到原图
+            # (尚未提交的图片原图仍在输入目录中，下次运行会重新处理)
+            drain_writes(wait=True)
             self.save_progress()
             raise
         
         finally:
+            # 其他异常退出时也等已提交的批次写完，未提交的图片原图仍在输入目录中，下次运行会重新处理
+            write_executor.shutdown(wait=True)
+            self.progress_log.close()
             progress_bar.close()
         
         # 更新最终统计